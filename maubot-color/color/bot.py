@@ -1,21 +1,50 @@
-import io
+from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
+from maubot.handlers import command, web
 from mautrix.types import ImageInfo, MediaMessageEventContent, MessageType
-from PIL import Image
+from mautrix.util.async_db import UpgradeTable
 import random
-from typing import TypedDict
+import re
+import time
+from typing import Callable, TypedDict
+from .db import DBManager, Swatch
+from .metrics import CONTENT_TYPE, Metrics, TimedDatabase, timed_command
+from .migrations import upgrade_table
+from .png import encode_rgb, solid
+
+# how many uploaded swatches are remembered before the least recently used ones are dropped
+MAX_SWATCHES = 4096
+# most colors a single palette can have
+MAX_PALETTE = 32
+# width of one color in a palette strip
+PALETTE_STRIPE = 64
+
+# rgb(r, g, b), #rrggbb (or just rrggbb) and #rgb
+COLOR_PATTERN = re.compile(r"rgb\(\s*(?P<r>\d{1,3})\s*,\s*(?P<g>\d{1,3})\s*,\s*(?P<b>\d{1,3})\s*\)|#?\b(?P<hex>[\da-fA-F]{6})\b|#(?P<short>[\da-fA-F]{3})\b", re.IGNORECASE)
 
 class UploadedImage(TypedDict):
 	url: str
 	info: ImageInfo
 
 class ColorBot(Plugin):
+	dbm: DBManager
+	metrics: Metrics
+
+	@classmethod
+	def get_db_upgrade_table(cls) -> UpgradeTable:
+		return upgrade_table
+
+	async def start(self) -> None:
+		await super().start()
+		self.metrics = Metrics("color")
+		self.dbm = DBManager(TimedDatabase(self.database, self.metrics))
+
 	@command.new(require_subcommand=True)
 	async def color(self, evt: MessageEvent) -> None:
 		pass
 
 	@color.subcommand("random", help="Returns a random color.", aliases=("r"))
+	@timed_command("random")
 	async def random(self, evt: MessageEvent) -> None:
 		r = random.randint(0, 255)
 		g = random.randint(0, 255)
@@ -30,6 +59,7 @@ class ColorBot(Plugin):
 
 	@color.subcommand("show", help="Preview the given color.", aliases=("s"))
 	@command.argument("hexColor", required=True, matches="[\da-fA-F]{6}", pass_raw=True)
+	@timed_command("show")
 	async def show(self, evt: MessageEvent, hexColor: str) -> None:
 		parsedHex = int(hexColor, 16)
 		b = parsedHex % 0x100
@@ -42,18 +72,65 @@ class ColorBot(Plugin):
 		await evt.reply("Here's your color: #" + hexColor)
 		await evt.respond(MediaMessageEventContent(url=url, info=info, body=hexColor + ".png", msgtype=MessageType.IMAGE))
 
+	@color.subcommand("palette", help="Preview many colors at once. Accepts #rrggbb, #rgb and rgb(r, g, b).", aliases=("p"))
+	@command.argument("colors", required=True, pass_raw=True)
+	@timed_command("palette")
+	async def palette(self, evt: MessageEvent, colors: str) -> None:
+		rgbs = self._parse_colors(colors)
+		if not rgbs:
+			await evt.reply("I couldn't find any color in that.")
+			return
+		if len(rgbs) > MAX_PALETTE:
+			await evt.reply(f"That's too many colors! A palette can have at most {MAX_PALETTE}.")
+			return
+		hexColors = list(map(self._hex, rgbs))
+		img: UploadedImage = await self._upload_palette(rgbs)
+		body = "Here's your palette: " + " ".join(map(lambda x: "#" + x, hexColors))
+		await evt.reply(MediaMessageEventContent(url=img["url"], info=img["info"], body=body, msgtype=MessageType.IMAGE))
+
+	@web.get("/metrics")
+	async def metrics_endpoint(self, req: Request) -> Response:
+		return Response(text=self.metrics.render(), headers={"Content-Type": CONTENT_TYPE})
+
+	def _parse_colors(self, text: str) -> list[list[int]]:
+		rgbs = list()
+		for match in COLOR_PATTERN.finditer(text):
+			if match["r"]:
+				rgbs.append(list(map(lambda x: min(int(x), 255), match.group("r", "g", "b"))))
+			else:
+				hexColor = match["hex"] or "".join(map(lambda x: x * 2, match["short"]))
+				parsedHex = int(hexColor, 16)
+				rgbs.append([parsedHex // 0x10000, (parsedHex // 0x100) % 0x100, parsedHex % 0x100])
+		return rgbs
+
+	def _hex(self, rgb: list[int]) -> str:
+		return ''.join(list(map(lambda x: (hex(x).split('x')[-1]).zfill(2).upper(), rgb)))
+
+	async def _upload_palette(self, rgbs: list[list[int]]) -> UploadedImage:
+		# all colors side by side in one strip, so the whole palette is one encode and one upload
+		width, height = PALETTE_STRIPE * len(rgbs), 32
+		row = b"".join(map(lambda rgb: bytes(rgb) * PALETTE_STRIPE, rgbs))
+		return await self._upload_cached("-".join(map(self._hex, rgbs)), lambda: (encode_rgb(width, height, row), width, height))
+
 	async def _upload_image(self, rgb: list[int]) -> UploadedImage:
-		hexColor = ''.join(list(map(lambda x: (hex(x).split('x')[-1]).zfill(2).upper(), rgb)))
-		info = ImageInfo()
-		# generate the image
-		img = Image.new("RGB", (128, 32), tuple(rgb))
-		imgByteArr = io.BytesIO()
-		img.save(imgByteArr, format="PNG")
-		imgByteArr = imgByteArr.getvalue()
+		return await self._upload_cached(self._hex(rgb), lambda: (solid(rgb, 128, 32), 128, 32))
+
+	async def _upload_cached(self, key: str, generate: Callable[[], tuple[bytes, int, int]]) -> UploadedImage:
+		now = int(time.time())
+		# every color (and palette) is only encoded and uploaded once
+		swatch = await self.dbm.getSwatch(key, now)
+		self.metrics.counter("swatch_lookups_total", "Swatch lookups, by whether the image was already uploaded.").inc(hit=bool(swatch))
+		if not swatch:
+			# generate the image
+			imgByteArr, width, height = generate()
+			# upload color image
+			with self.metrics.histogram("media_upload_duration_seconds", "Time taken to upload an image to the homeserver.").time(mimetype="image/png"):
+				url = await self.client.upload_media(imgByteArr, "image/png", key + ".png")
+			swatch = Swatch(hex=key, mxc=url, size=len(imgByteArr), width=width, height=height)
+			await self.dbm.saveSwatch(swatch, now, MAX_SWATCHES)
 		# write image info
+		info = ImageInfo()
 		info.mimetype = "image/png"
-		info.size = len(imgByteArr)
-		info.width, info.height = img.size
-		# upload color image
-		url = await self.client.upload_media(imgByteArr, info.mimetype, hexColor + ".png")
-		return { "url": url, "info": info }
+		info.size = swatch.size
+		info.width, info.height = swatch.width, swatch.height
+		return { "url": swatch.mxc, "info": info }
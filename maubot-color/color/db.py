@@ -0,0 +1,58 @@
+from __future__ import annotations
+from asyncpg import Record
+from attr import dataclass
+from mautrix.types import ContentURI
+from mautrix.util.async_db import Database
+
+@dataclass
+class Swatch:
+	hex: str
+	mxc: ContentURI
+	size: int
+	width: int
+	height: int
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> Swatch | None:
+		if not row:
+			return None
+		mxc = row["mxc"]
+		if not mxc:
+			return None
+		return cls(
+			hex=row["hex"],
+			mxc=mxc,
+			size=row["size"],
+			width=row["width"],
+			height=row["height"]
+		)
+
+class DBManager:
+	db: Database
+
+	def __init__(self, db: Database) -> None:
+		self.db = db
+
+	async def getSwatch(self, hex: str, now: int) -> Swatch | None:
+		q = """
+		UPDATE swatch SET last_used = $2
+		WHERE hex = $1
+		RETURNING hex, mxc, size, width, height
+		"""
+		row = await self.db.fetchrow(q, hex, now)
+		return Swatch.from_row(row)
+
+	async def saveSwatch(self, swatch: Swatch, now: int, limit: int) -> None:
+		q = """
+		INSERT INTO swatch (hex, mxc, size, width, height, last_used)
+		VALUES ($1, $2, $3, $4, $5, $6)
+		ON CONFLICT (hex) DO UPDATE
+		SET mxc = excluded.mxc, size = excluded.size, width = excluded.width, height = excluded.height, last_used = excluded.last_used
+		"""
+		await self.db.execute(q, swatch.hex, swatch.mxc, swatch.size, swatch.width, swatch.height, now)
+		# forget the least recently used swatches once there are too many
+		q = """
+		DELETE FROM swatch
+		WHERE last_used < (SELECT last_used FROM swatch ORDER BY last_used DESC LIMIT 1 OFFSET $1)
+		"""
+		await self.db.execute(q, limit - 1)
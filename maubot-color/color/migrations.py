@@ -0,0 +1,19 @@
+from mautrix.util.async_db import Connection, UpgradeTable
+
+upgrade_table = UpgradeTable()
+
+@upgrade_table.register(description="Uploaded swatch cache")
+async def upgrade_v1(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS swatch (
+			hex TEXT NOT NULL,
+			mxc TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			width INTEGER NOT NULL,
+			height INTEGER NOT NULL,
+			last_used BIGINT NOT NULL,
+
+			PRIMARY KEY (hex)
+		)"""
+	)
+	await conn.execute("CREATE INDEX IF NOT EXISTS swatch_last_used_idx ON swatch (last_used)")
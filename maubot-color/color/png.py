@@ -0,0 +1,18 @@
+import struct
+import zlib
+
+# just enough of PNG to write 8-bit RGB images without going through PIL
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+	return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def encode_rgb(width: int, height: int, row: bytes) -> bytes:
+	# every row of the image is the same `width * 3` bytes, which is all swatches and palettes need
+	scanline = b"\x00" + row
+	header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+	return SIGNATURE + _chunk(b"IHDR", header) + _chunk(b"IDAT", zlib.compress(scanline * height, 9)) + _chunk(b"IEND", b"")
+
+def solid(rgb: list[int], width: int, height: int) -> bytes:
+	return encode_rgb(width, height, bytes(rgb) * width)
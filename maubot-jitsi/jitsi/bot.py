@@ -1,18 +1,77 @@
+from aiohttp.web import Request, Response
 import io
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
-from mautrix.types import ImageInfo, MediaMessageEventContent, MessageType
+from maubot.handlers import command, event, web
+from mautrix.types import EventType, ImageInfo, MediaMessageEventContent, Membership, MessageType, RoomID, StateEvent
 from PIL import Image
 import random
 from typing import TypedDict
+from .metrics import CONTENT_TYPE, Metrics, timed_command
+
+WIDGET_EVENT = EventType.find("im.vector.modular.widgets", EventType.Class.STATE)
 
 class JitsiPlugin(Plugin):
+	metrics: Metrics
+	# jitsi links of every room we've been asked about, by widget state key
+	widgets: dict[RoomID, dict[str, str]]
+
+	async def start(self) -> None:
+		await super().start()
+		self.metrics = Metrics("jitsi")
+		self.widgets = dict()
+
 	@command.new(help="Print the Jitsi Meet link name for this room, if enabled.", require_subcommand=False)
+	@timed_command("jitsi")
 	async def jitsi(self, evt: MessageEvent) -> None:
-		states = await self.client.get_state(evt.room_id)
-		filtered = list(filter(lambda x: str(x["type"]) == "im.vector.modular.widgets" and x["content"]["type"] == "jitsi", states))
-		if len(filtered) == 0:
+		links = await self._get_widgets(evt.room_id)
+		if len(links) == 0:
 			await evt.reply("This room doesn't have Jitsi!")
 		else:
-			state = filtered[0]
-			await evt.reply("https://" + state["content"]["data"]["domain"] + "/" + state["content"]["data"]["conferenceId"])
\ No newline at end of file
+			await evt.reply(next(iter(links.values())))
+
+	@event.on(WIDGET_EVENT)
+	async def widget(self, evt: StateEvent) -> None:
+		links = self.widgets.get(evt.room_id)
+		if links is None:
+			# nobody asked for this room yet, it'll be fetched in full when someone does
+			return
+		link = self._jitsi_link(evt.content.serialize())
+		if link:
+			links[evt.state_key] = link
+		else:
+			# removed, or replaced with something that isn't jitsi
+			links.pop(evt.state_key, None)
+
+	@event.on(EventType.ROOM_MEMBER)
+	async def member(self, evt: StateEvent) -> None:
+		if evt.state_key == self.client.mxid and evt.content.membership != Membership.JOIN:
+			# widget events stop coming once we're out, so it has to be fetched again if we ever come back
+			self.widgets.pop(evt.room_id, None)
+
+	@web.get("/metrics")
+	async def metrics_endpoint(self, req: Request) -> Response:
+		return Response(text=self.metrics.render(), headers={"Content-Type": CONTENT_TYPE})
+
+	async def _get_widgets(self, roomId: RoomID) -> dict[str, str]:
+		links = self.widgets.get(roomId)
+		self.metrics.counter("widget_cache_lookups_total", "Widget lookups, by whether the room was already cached.").inc(hit=links is not None)
+		if links is not None:
+			return links
+		# the room state is only fetched once, widget events keep it up to date afterwards
+		links = dict()
+		for state in await self.client.get_state(roomId):
+			if str(state["type"]) != WIDGET_EVENT.t:
+				continue
+			link = self._jitsi_link(state["content"].serialize())
+			if link:
+				links[state["state_key"]] = link
+		self.widgets[roomId] = links
+		return links
+
+	def _jitsi_link(self, content: dict) -> str | None:
+		if content.get("type") != "jitsi":
+			return None
+		data = content.get("data") or dict()
+		if not data.get("domain") or not data.get("conferenceId"):
+			return None
+		return "https://" + data["domain"] + "/" + data["conferenceId"]
@@ -0,0 +1,117 @@
+# Compares the render path of the old dotdict wrapper with the parsed schedule model,
+# and what the schedules cache keeps with and without the decoded document next to the model.
+# Usage: python bench/bench_model.py [fixture.json]
+import importlib.util
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# load the model without importing the plugin (and thus maubot)
+spec = importlib.util.spec_from_file_location("splatoon3_models", os.path.join(HERE, "..", "splatoon3", "models.py"))
+models = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = models
+spec.loader.exec_module(models)
+
+# the wrapper the plugin used before the model
+class dotdict(dict):
+	def __getattr__(*args):
+		val = dict.get(*args)
+		if type(val) is dict:
+			return dotdict(val)
+		if type(val) is list:
+			return list(map(lambda x: dotdict(x) if type(x) is dict else x, val))
+		return val
+
+def iso_str(iso: str, tz: int = 0) -> str:
+	return (datetime.fromisoformat(iso).replace(tzinfo=timezone.utc) + timedelta(hours=tz)).strftime("%m/%d %H:%M")
+
+def time_str(time: datetime, tz: int = 0) -> str:
+	return (time + timedelta(hours=tz)).strftime("%m/%d %H:%M")
+
+def render_dotdict(raw: dict) -> str:
+	data = dotdict(raw).data
+	description = ""
+	for node in data.bankaraSchedules.nodes:
+		if not node.bankaraMatchSettings:
+			continue
+		description += "**" + iso_str(node.startTime) + "**"
+		for setting in node.bankaraMatchSettings:
+			description += "  \n" + " | ".join(map(lambda x: x.name, setting.vsStages)) + " **" + setting.vsRule.name + "**"
+	for node in data.xSchedules.nodes:
+		if not node.xMatchSetting:
+			continue
+		description += "**" + iso_str(node.startTime) + "**"
+		description += "  \n" + " | ".join(map(lambda x: x.name, node.xMatchSetting.vsStages)) + " **" + node.xMatchSetting.vsRule.name + "**"
+	for node in data.eventSchedules.nodes:
+		description += "\n# " + node.leagueMatchSetting.leagueMatchEvent.name + "\n"
+		description += node.leagueMatchSetting.leagueMatchEvent.desc + "\n\n"
+		description += "**" + iso_str(node.timePeriods[0].startTime) + " - " + iso_str(node.timePeriods[-1].endTime) + "**"
+		description += "  \n" + " | ".join(map(lambda x: x.name, node.leagueMatchSetting.vsStages)) + " **" + node.leagueMatchSetting.vsRule.name + "**"
+	for node in data.coopGroupingSchedule.regularSchedules.nodes:
+		description += "\n\n**" + iso_str(node.startTime) + " - " + iso_str(node.endTime) + "**"
+		description += "  \n" + node.setting.coopStage.name + " | " + node.setting.boss.name
+		description += "  \n" + " / ".join(map(lambda w: w.name, node.setting.weapons))
+	return description
+
+def render_model(data) -> str:
+	description = ""
+	for node in data.bankara:
+		if not node.settings:
+			continue
+		description += "**" + time_str(node.start) + "**"
+		for setting in node.settings:
+			description += "  \n" + " | ".join(map(lambda x: x.name, setting.stages)) + " **" + setting.rule.name + "**"
+	for node in data.x:
+		if not node.settings:
+			continue
+		description += "**" + time_str(node.start) + "**"
+		description += "  \n" + " | ".join(map(lambda x: x.name, node.settings[0].stages)) + " **" + node.settings[0].rule.name + "**"
+	for node in data.challenges:
+		description += "\n# " + node.event.name + "\n"
+		description += node.event.desc + "\n\n"
+		description += "**" + time_str(node.periods[0].start) + " - " + time_str(node.periods[-1].end) + "**"
+		description += "  \n" + " | ".join(map(lambda x: x.name, node.setting.stages)) + " **" + node.setting.rule.name + "**"
+	for node in data.salmon:
+		description += "\n\n**" + time_str(node.start) + " - " + time_str(node.end) + "**"
+		description += "  \n" + node.setting.stage.name + " | " + node.setting.boss
+		description += "  \n" + " / ".join(node.setting.weapons)
+	return description
+
+def measure(name: str, fn, number: int) -> None:
+	seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+	tracemalloc.start()
+	fn()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:<32} {seconds * 1e6:>10.1f} us/op {peak / 1024:>10.1f} KiB peak")
+
+def retained(name: str, fn) -> None:
+	# memory still held by whatever fn returns
+	tracemalloc.start()
+	kept = fn()
+	current, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del kept
+	print(f"{name:<32} {current / 1024:>10.1f} KiB retained")
+
+def main() -> None:
+	path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(HERE, "fixtures", "schedules.json")
+	with open(path) as f:
+		body = f.read()
+	raw = json.loads(body)
+	model = models.Schedules.from_json(raw)
+	assert render_dotdict(raw) == render_model(model)
+	measure("parse (model, once)", lambda: models.Schedules.from_json(raw), 200)
+	measure("fetch (json + model)", lambda: models.Schedules.from_json(json.loads(body)), 200)
+	retained("document + model", lambda: (json.loads(body), models.Schedules.from_json(json.loads(body))))
+	retained("model only", lambda: models.Schedules.from_json(json.loads(body)))
+	measure("render (dotdict)", lambda: render_dotdict(raw), 200)
+	measure("render (model)", lambda: render_model(model), 200)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,376 @@
+# Replays the recorded splatoon3.ink responses against the plugin, with a local stub server instead of
+# splatoon3.ink and a fake client instead of a homeserver. Times the render path of every subcommand,
+# rotation checks for different numbers of subscribed rooms and image sending.
+# Usage: python bench/bench_plugin.py [--rooms 1,100,10000] [--iterations 200] [--send-latency 0]
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from aiohttp import ClientSession, web
+from mautrix.types import EventType
+from mautrix.util.async_db import Database
+from PIL import Image
+from ruamel.yaml import YAML
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures")
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from splatoon3.bot import IMAGE_PART, TEXT_PART, Splatoon3Plugin
+from splatoon3.cache import ReplyCache, UpstreamCache, schedules_boundary
+from splatoon3.db import DBManager
+from splatoon3.history import RotationHistory
+from splatoon3.media import MediaCache
+from splatoon3.metrics import Metrics
+from splatoon3.migrations import upgrade_table
+from splatoon3.models import Festivals, Schedules
+from splatoon3.prefs import UserPrefs, displayname_timezone
+from splatoon3.scheduler import ALL, CHALLENGE, FEST, SCHEDULES, RotationScheduler
+from splatoon3.subscriptions import SubscriptionRegistry
+
+# when the recorded fixtures start. "now" is moved to an hour after it, in the middle of the first rotation
+# and of the first challenge period, with the newest fests still to come
+RECORDED_AT = datetime(2024, 5, 4, 0, 0, tzinfo=timezone.utc)
+UPSTREAM = "https://splatoon3.ink"
+SCHEDULE_FIXTURES = ("schedules", "schedules-splatfest", "schedules-bigrun", "schedules-eggstra")
+SUBCOMMANDS = ("splatoon3", "turf", "anarchy", "x", "fest", "salmon", "challenge")
+
+def shift_times(node, delta: timedelta):
+	# moves every upstream time by the same amount, so the fixtures describe the present
+	if isinstance(node, dict):
+		for key, value in node.items():
+			if key.endswith("Time") and isinstance(value, str):
+				node[key] = (datetime.fromisoformat(value) + delta).strftime("%Y-%m-%dT%H:%M:%SZ")
+			else:
+				shift_times(value, delta)
+	elif isinstance(node, list):
+		for value in node:
+			shift_times(value, delta)
+
+def overlap_challenges(raw: dict) -> None:
+	# the second challenge moves back so its second period is on now, next to the first one starting
+	periods = raw["data"]["eventSchedules"]["nodes"][1]["timePeriods"]
+	start = RECORDED_AT - timedelta(hours=8)
+	for ii, period in enumerate(periods):
+		period["startTime"] = (start + timedelta(hours=8 * ii)).strftime("%Y-%m-%dT%H:%M:%SZ")
+		period["endTime"] = (start + timedelta(hours=8 * ii + 2)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def load_fixture(name: str, delta: timedelta, base: str, edit=None) -> bytes:
+	with open(os.path.join(FIXTURES, name + ".json")) as f:
+		raw = json.load(f)
+	if edit:
+		edit(raw)
+	shift_times(raw, delta)
+	return json.dumps(raw).replace(UPSTREAM, base).encode()
+
+def flatten(config: dict, prefix: str = "") -> dict:
+	flat = dict()
+	for key, value in config.items():
+		if isinstance(value, dict):
+			flat.update(flatten(value, prefix + key + "."))
+		else:
+			flat[prefix + key] = value
+	return flat
+
+def percentiles(samples: list[float]) -> str:
+	ordered = sorted(samples)
+	pick = lambda p: ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+	return f"p50 {pick(0.5) * 1e3:>9.3f} ms  p95 {pick(0.95) * 1e3:>9.3f} ms  p99 {pick(0.99) * 1e3:>9.3f} ms  max {ordered[-1] * 1e3:>9.3f} ms"
+
+class Member:
+	def __init__(self, displayname: str) -> None:
+		self.displayname = displayname
+
+class FakeClient:
+	# records what would have been sent to the homeserver
+	mxid = "@bench:localhost"
+
+	def __init__(self, latency: float = 0) -> None:
+		self.latency = latency
+		self.sent = 0
+		self.uploads = 0
+		# the last message every room got
+		self.last = dict()
+
+	async def send_message_event(self, roomId, eventType, content, **kwargs) -> str:
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		self.sent += 1
+		self.last[roomId] = content
+		return f"$event{self.sent}"
+
+	async def upload_media(self, data: bytes, mimetype: str, filename: str) -> str:
+		self.uploads += 1
+		return f"mxc://localhost/upload{self.uploads}"
+
+	async def get_state_event(self, roomId, eventType, stateKey) -> Member:
+		return Member("bench +9")
+
+	async def get_joined_members(self, roomId) -> dict:
+		return {"@user:localhost": Member("bench +9")}
+
+class FakeEvent:
+	room_id = "!bench:localhost"
+	sender = "@user:localhost"
+
+	def __init__(self, client: FakeClient) -> None:
+		self.client = client
+		self.replies = list()
+
+	async def reply(self, content, **kwargs) -> str:
+		self.replies.append(content)
+		return "$reply"
+
+	def json(self) -> str:
+		return "{}"
+
+class StubUpstream:
+	# serves the fixtures under the paths splatoon3.ink uses, and the same picture for every asset
+	def __init__(self, delta: timedelta) -> None:
+		self.delta = delta
+		self.documents = dict()
+		self.runner = None
+		self.base = ""
+		img = Image.new("RGB", (640, 360), (240, 80, 20))
+		imgByteArr = io.BytesIO()
+		img.save(imgByteArr, format="PNG")
+		self.image = imgByteArr.getvalue()
+
+	async def start(self) -> None:
+		app = web.Application()
+		app.router.add_get("/data/{name}.json", self._data)
+		app.router.add_get("/assets/{path:.*}", self._asset)
+		self.runner = web.AppRunner(app, access_log=None)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, "127.0.0.1", 0)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+		self.base = f"http://127.0.0.1:{port}"
+		for name in SCHEDULE_FIXTURES + ("festivals",):
+			self.documents[name] = load_fixture(name, self.delta, self.base)
+		self.documents["schedules-challenges"] = load_fixture("schedules", self.delta, self.base, overlap_challenges)
+		# what the plugin asks for as schedules.json, switched per fixture
+		self.documents["schedules.current"] = self.documents["schedules"]
+
+	async def stop(self) -> None:
+		await self.runner.cleanup()
+
+	def use(self, name: str) -> None:
+		self.documents["schedules.current"] = self.documents[name]
+
+	async def _data(self, request: web.Request) -> web.Response:
+		name = request.match_info["name"]
+		body = self.documents.get("schedules.current" if name == "schedules" else name)
+		if body is None:
+			return web.Response(status=404)
+		return web.Response(body=body, content_type="application/json")
+
+	async def _asset(self, request: web.Request) -> web.Response:
+		return web.Response(body=self.image, content_type="image/png")
+
+async def make_plugin(http: ClientSession, upstream: StubUpstream, client: FakeClient, database: Database) -> Splatoon3Plugin:
+	# everything start() sets up, pointed at the stub server
+	plugin = Splatoon3Plugin.__new__(Splatoon3Plugin)
+	plugin.log = logging.getLogger("bench")
+	plugin.client = client
+	plugin.http = http
+	with open(os.path.join(HERE, "..", "base-config.yaml")) as f:
+		plugin.config = flatten(YAML().load(f))
+	plugin.lastDelivery = None
+	plugin.metrics = Metrics("splatoon3")
+	plugin.dbm = DBManager(database)
+	plugin.registry = SubscriptionRegistry(plugin.dbm)
+	plugin.prefs = UserPrefs(plugin.dbm)
+	plugin.history = RotationHistory(plugin.dbm)
+	plugin.schedules = UpstreamCache(http, upstream.base + "/data/schedules.json", plugin.dbm, schedules_boundary, Schedules.from_json, onChange=plugin._archive)
+	plugin.festivals = UpstreamCache(http, upstream.base + "/data/festivals.json", plugin.dbm, parse=Festivals.from_json)
+	plugin.replies = ReplyCache()
+	plugin.displaynames = dict()
+	plugin.media = MediaCache(http, client, plugin.dbm, plugin.config["media.max_passthrough_size"], plugin.config["media.thumbnail_size"])
+	plugin.scheduler = RotationScheduler()
+	return plugin
+
+async def timed(fn, iterations: int) -> list[float]:
+	samples = list()
+	for _ in range(iterations):
+		start = time.perf_counter()
+		await fn()
+		samples.append(time.perf_counter() - start)
+	return samples
+
+async def traced(fn) -> float:
+	tracemalloc.start()
+	await fn()
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return peak / 1024
+
+async def report(name: str, fn, iterations: int) -> None:
+	samples = await timed(fn, iterations)
+	peak = await traced(fn)
+	print(f"{name:<34} {percentiles(samples)}  {peak:>10.1f} KiB peak")
+
+async def bench_timezones(plugin: Splatoon3Plugin, iterations: int) -> None:
+	evt = FakeEvent(plugin.client)
+	print("\n## timezone of the sender")
+	async def fallback() -> None:
+		await plugin._get_sender_timezone(evt)
+	async def uncached() -> None:
+		displayname_timezone.cache_clear()
+		await plugin._get_sender_timezone(evt)
+	await report("from displayname (uncached regex)", uncached, iterations)
+	await report("from displayname", fallback, iterations)
+	await plugin.prefs.setTimezone(evt.sender, "Asia/Tokyo")
+	await report("from timezone preference", fallback, iterations)
+	await plugin.prefs.setTimezone(evt.sender, None)
+
+async def bench_subcommands(plugin: Splatoon3Plugin, upstream: StubUpstream, iterations: int) -> None:
+	evt = FakeEvent(plugin.client)
+	for fixture in SCHEDULE_FIXTURES:
+		upstream.use(fixture)
+		plugin.schedules.invalidate()
+		data = await plugin.schedules.get(wait=True)
+		print(f"\n## {fixture}")
+		for name in SUBCOMMANDS:
+			render = getattr(plugin, "_render_" + name)
+			async def cold(render=render) -> None:
+				render(data, "+09:00")
+			handler = getattr(Splatoon3Plugin, name).__mb_func__
+			async def warm(handler=handler) -> None:
+				await handler(plugin, evt)
+			await report(f"render {name}", cold, iterations)
+			await report(f"!{name} (cached reply)", warm, iterations)
+
+async def bench_rotation_update(plugin: Splatoon3Plugin, upstream: StubUpstream, database: Database, rooms: list[int], iterations: int) -> None:
+	upstream.use("schedules")
+	plugin.schedules.invalidate()
+	print("\n## rotation update (challenge start, fest vote)")
+	for count in rooms:
+		await database.execute("DELETE FROM subscription")
+		await database.executemany(
+			"INSERT INTO subscription (room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon) VALUES ($1, true, true, true, true, true)",
+			[(f"!room{ii:06d}:localhost",) for ii in range(count)]
+		)
+		await plugin.registry.load()
+
+		async def run() -> None:
+			# every run finds the challenge and the fests new again
+			await database.execute("DELETE FROM past_fest")
+			await database.execute("DELETE FROM notification")
+			await plugin._rotationUpdate(ALL)
+
+		before = plugin.client.sent
+		await run()
+		sentPerRun = plugin.client.sent - before
+		await report(f"_rotationUpdate {count} rooms", run, max(iterations // max(count // 10, 1), 3))
+		print(f"{'':<34} {sentPerRun} messages per run, delivery {plugin.lastDelivery.summary() if plugin.lastDelivery else 'skipped'}")
+
+async def check_challenges(plugin: Splatoon3Plugin, upstream: StubUpstream, database: Database) -> None:
+	print("\n## challenge starting and another one happening in the same run")
+	upstream.use("schedules-challenges")
+	plugin.schedules.invalidate()
+	await database.execute("DELETE FROM subscription")
+	await database.execute("DELETE FROM notification")
+	await database.executemany(
+		"INSERT INTO subscription (room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon) VALUES ($1, false, false, $2, $3, false)",
+		[("!start:localhost", True, False), ("!happen:localhost", False, True), ("!both:localhost", True, True)]
+	)
+	await plugin.registry.load()
+	plugin.client.last.clear()
+	await plugin._rotationUpdate({CHALLENGE})
+	bodies = {roomId: content["body"] for roomId, content in plugin.client.last.items()}
+	assert "Too Many Trizookas!" in bodies["!start:localhost"] and "Hero Mode Heroes" not in bodies["!start:localhost"], bodies
+	for roomId in ("!happen:localhost", "!both:localhost"):
+		assert "Too Many Trizookas!" in bodies[roomId] and "Hero Mode Heroes" in bodies[roomId], bodies
+	# both periods are claimed now, so nobody hears about them twice
+	plugin.client.last.clear()
+	await plugin._rotationUpdate({CHALLENGE})
+	assert not plugin.client.last, plugin.client.last
+	print("start notice to event_start rooms, both notices to event_happen rooms, nothing on the next run")
+
+async def bench_reschedule(plugin: Splatoon3Plugin, upstream: StubUpstream, iterations: int) -> None:
+	print("\n## rescheduling")
+	upstream.use("schedules")
+	plugin.schedules.invalidate()
+	plugin.scheduler = RotationScheduler()
+	await plugin._reschedule()
+	# with nothing queued the checker would sleep forever
+	kinds = {kind for _, kind in plugin.scheduler.heap}
+	assert SCHEDULES in kinds and FEST in kinds, f"_reschedule queued nothing: {plugin.scheduler.heap}"
+	await report("_reschedule", plugin._reschedule, iterations)
+
+async def bench_history(plugin: Splatoon3Plugin, upstream: StubUpstream, iterations: int) -> None:
+	print("\n## rotation history")
+	upstream.use("schedules")
+	plugin.schedules.invalidate()
+	# fetching archives the document, no rotation check needed
+	await plugin.schedules.get(wait=True)
+	assert plugin.history.stages, "fetching schedules archived nothing"
+	stage = plugin.schedules.model.regular[0].settings[0].stages[0].name
+	evt = FakeEvent(plugin.client)
+	for name, handler, expected in (("next", Splatoon3Plugin.next_stage, "is next up in"), ("stats", Splatoon3Plugin.stage_stats, "has been played")):
+		async def run(handler=handler) -> None:
+			await handler.__mb_func__(plugin, evt, stage.lower())
+		await run()
+		assert expected in evt.replies[-1], f"!splatoon3 {name} replied: {evt.replies[-1]}"
+		await report(f"!splatoon3 {name} <stage>", run, iterations)
+
+async def bench_images(plugin: Splatoon3Plugin, upstream: StubUpstream, iterations: int) -> None:
+	print("\n## image sending")
+	url = upstream.base + "/assets/splatnet/v1/fest_img/bench_0.jpg"
+	count = 0
+
+	async def send(imageUrl: str) -> None:
+		content = await plugin._compose(((TEXT_PART, "# Fest"), (IMAGE_PART, imageUrl)), dict())
+		await plugin.client.send_message_event("!bench:localhost", EventType.ROOM_MESSAGE, content)
+
+	async def cold() -> None:
+		# a url nobody has seen yet: download, upload and store
+		nonlocal count
+		count += 1
+		plugin.media.known.clear()
+		await send(f"{url}?{count}")
+
+	async def warm() -> None:
+		await send(url)
+
+	await report("send image (new url)", cold, iterations)
+	await report("send image (known)", warm, iterations)
+
+async def main() -> None:
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rooms", default="1,100,10000", help="comma separated numbers of subscribed rooms")
+	parser.add_argument("--iterations", type=int, default=200)
+	parser.add_argument("--send-latency", type=float, default=0, help="seconds the fake homeserver takes per message")
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.WARNING)
+
+	delta = datetime.now(timezone.utc).replace(microsecond=0) - RECORDED_AT - timedelta(hours=1)
+	upstream = StubUpstream(delta)
+	await upstream.start()
+	with tempfile.TemporaryDirectory() as tmp:
+		database = Database.create(f"sqlite:///{tmp}/bench.db", upgrade_table=upgrade_table)
+		await database.start()
+		try:
+			async with ClientSession() as http:
+				plugin = await make_plugin(http, upstream, FakeClient(args.send_latency), database)
+				await bench_timezones(plugin, args.iterations)
+				await bench_subcommands(plugin, upstream, args.iterations)
+				await bench_reschedule(plugin, upstream, args.iterations)
+				await bench_history(plugin, upstream, args.iterations)
+				await check_challenges(plugin, upstream, database)
+				await bench_rotation_update(plugin, upstream, database, list(map(int, args.rooms.split(","))), args.iterations)
+				await bench_images(plugin, upstream, min(args.iterations, 50))
+		finally:
+			await database.stop()
+			await upstream.stop()
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -1,34 +1,66 @@
 import asyncio
 from datetime import datetime, timedelta, timezone
-import io
+from aiohttp.web import Request, Response
+from functools import partial
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command, event
+from maubot.handlers import command, event, web
 from maubot.matrix import parse_formatted
-from mautrix.types import EventType, Format, ImageInfo, MediaMessageEventContent, MessageType, RoomID, StateEvent, TextMessageEventContent
+from mautrix.errors import MatrixRequestError
+from mautrix.types import EventType, Format, Membership, MessageType, RoomID, StateEvent, TextMessageEventContent, UserID
 from mautrix.util.async_db import UpgradeTable
-from PIL import Image
-import re
+from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 import time
+from typing import Awaitable, Callable, Set
+from uuid import uuid4
+from .cache import FESTIVALS_URL, RETRY_DELAY, ROTATION_SECONDS, SCHEDULES_URL, ReplyCache, UpstreamCache, schedules_boundary
 from .db import DBManager
+from .delivery import Delivery, DeliveryStats, Send
+from .history import MODE_NAMES, RotationHistory
+from .leader import RENEW_SECONDS, LeaderLease
+from .media import MediaCache
+from .metrics import CONTENT_TYPE, Metrics, TimedDatabase, timed_command
 from .migrations import upgrade_table
-
-# remind you that i'm a javascript programmer
-class dotdict(dict):
-	# dot.notation access to dictionary attributes
-	# https://stackoverflow.com/questions/2352181/how-to-use-a-dot-to-access-members-of-dictionary
-	def __getattr__(*args):
-		val = dict.get(*args)
-		if type(val) is dict:
-			return dotdict(val)
-		if type(val) is list:
-			return list(map(lambda x: dotdict(x) if type(x) is dict else x, val))
-		return val
-	__setattr__ = dict.__setitem__
-	__delattr__ = dict.__delitem__
+from .models import ISO_FORMAT, Festivals, Schedules, Stage, TimePeriod
+from .prefs import UTC, UserPrefs, displayname_timezone, get_tzinfo, normalize_timezone, timezone_label
+from .scheduler import ALL, BIG_RUN, CHALLENGE, FEST, NOTIFY, SCHEDULES, RotationScheduler
+from .subscriptions import SubscriptionRegistry
+
+# what a notification is made of
+TEXT_PART = "text"
+IMAGE_PART = "image"
+# longest side of images shown inside notifications
+INLINE_IMAGE_SIZE = 400
+
+class Config(BaseProxyConfig):
+	def do_update(self, helper: ConfigUpdateHelper) -> None:
+		helper.copy("notifications.parallelism")
+		helper.copy("notifications.retries")
+		helper.copy("notifications.backoff")
+		helper.copy("media.max_passthrough_size")
+		helper.copy("media.thumbnail_size")
+		helper.copy("fests.retention_days")
+		helper.copy("http.timeout")
 
 class Splatoon3Plugin(Plugin):
 	dbm: DBManager
 	task: asyncio.Future
+	leaseTask: asyncio.Future
+	lease: LeaderLease
+	schedules: UpstreamCache
+	festivals: UpstreamCache
+	replies: ReplyCache
+	displaynames: dict[RoomID, dict[UserID, str]]
+	prefs: UserPrefs
+	history: RotationHistory
+	lastDelivery: DeliveryStats | None
+	media: MediaCache
+	scheduler: RotationScheduler
+	registry: SubscriptionRegistry
+	metrics: Metrics
+
+	@classmethod
+	def get_config_class(cls) -> type[BaseProxyConfig]:
+		return Config
 
 	@classmethod
 	def get_db_upgrade_table(cls) -> UpgradeTable:
@@ -36,214 +68,122 @@ class Splatoon3Plugin(Plugin):
 
 	async def start(self) -> None:
 		await super().start()
-		self.dbm = DBManager(self.database)
+		self.config.load_and_update()
+		self.lastDelivery = None
+		self.metrics = Metrics("splatoon3")
+		self.dbm = DBManager(TimedDatabase(self.database, self.metrics))
+		self.registry = SubscriptionRegistry(self.dbm)
+		await self.registry.load()
+		self.prefs = UserPrefs(self.dbm)
+		await self.prefs.load()
+		self.history = RotationHistory(self.dbm)
+		await self.history.load()
+		self.schedules = UpstreamCache(self.http, SCHEDULES_URL, self.dbm, schedules_boundary, Schedules.from_json, timeout=self.config["http.timeout"], metrics=self.metrics, onChange=self._archive)
+		self.festivals = UpstreamCache(self.http, FESTIVALS_URL, self.dbm, parse=Festivals.from_json, timeout=self.config["http.timeout"], metrics=self.metrics)
+		self.replies = ReplyCache()
+		self.displaynames = dict()
+		self.media = MediaCache(self.http, self.client, self.dbm, self.config["media.max_passthrough_size"], self.config["media.thumbnail_size"], self.metrics)
+		await self.schedules.load()
+		await self.festivals.load()
+		# until this instance gets the lease, someone else may be keeping the cached data fresh
+		self.schedules.readOnly = self.festivals.readOnly = True
+		self._register_metrics()
+		self.scheduler = RotationScheduler()
+		self.lease = LeaderLease(self.database, f"{self.id}/{uuid4().hex[:8]}")
 		self.task = asyncio.create_task(self.rotationUpdateLoop())
+		self.leaseTask = asyncio.create_task(self.leaseLoop())
+
+	async def stop(self) -> None:
+		self.task.cancel()
+		self.leaseTask.cancel()
+		try:
+			# let another instance take over right away
+			await self.lease.release()
+		except Exception:
+			self.log.exception("Failed to release the rotation checker lease")
+		await super().stop()
 
 	@command.new(help="Shows you the current rotation.", require_subcommand=False)
+	@timed_command("splatoon3")
 	async def splatoon3(self, evt: MessageEvent) -> None:
 		self.log.debug(evt.json())
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		description = "**Current rotation:**"
-		if data.regularSchedules.nodes[0].regularMatchSetting:
-			setting = data.regularSchedules.nodes[0].regularMatchSetting
-			description += "  \nTurf War: " + self._stages_str(setting.vsStages)
-		if data.bankaraSchedules.nodes[0].bankaraMatchSettings:
-			setting = data.bankaraSchedules.nodes[0].bankaraMatchSettings[0]
-			description += "  \n" + setting.vsRule.name + " (Series): " + self._stages_str(setting.vsStages)
-			setting = data.bankaraSchedules.nodes[0].bankaraMatchSettings[1]
-			description += "  \n" + setting.vsRule.name + " (Open): " + self._stages_str(setting.vsStages)
-		if data.xSchedules.nodes[0].xMatchSetting:
-			setting = data.xSchedules.nodes[0].xMatchSetting
-			mode = data.xSchedules.nodes[0].xMatchSetting.vsRule.name
-			description += "  \n" + setting.vsRule.name + " (X): " + self._stages_str(setting.vsStages)
-		if data.currentFest:
-			# todo when splatfest happens
-			pass
-		if data.festSchedules.nodes[0].festMatchSettings:
-			setting = data.festSchedules.nodes[0].festMatchSettings[0]
-			description += "  \nSplatfest (Open): " + self._stages_str(setting.vsStages)
-			setting = data.festSchedules.nodes[0].festMatchSettings[1]
-			description += "  \nSplatfest (Pro): " + self._stages_str(setting.vsStages)
-		
-		coopSchedule = data.coopGroupingSchedule
-		if len(coopSchedule.regularSchedules.nodes) > 0:
-			setting = coopSchedule.regularSchedules.nodes[0].setting
-			description += "\n\n**Salmon Run:**  \n" + setting.coopStage.name + " | " + setting.boss.name + "  \n"
-			description += " / ".join(map(lambda w: w.name, setting.weapons))
-		if len(coopSchedule.bigRunSchedules.nodes) > 0:
-			# todo when big run happens
-			pass
-		if len(coopSchedule.teamContestSchedules.nodes) > 0:
-			# todo when eggstra work happens
-			pass
-
-		if len(data.eventSchedules.nodes[0].timePeriods) > 0:
-			nextChallengeTime = data.eventSchedules.nodes[0].timePeriods[self._get_next_period_index(data.eventSchedules.nodes[0].timePeriods)]
-			challengeName = data.eventSchedules.nodes[0].leagueMatchSetting.leagueMatchEvent.name
-			description += "\n\n**" + challengeName + "** "
-			if self._is_now_between_isos(nextChallengeTime.startTime, nextChallengeTime.endTime):
-				description += "is happening **right now!**"
-			else:
-				tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-				description += f"will happen on **{self._iso_str(nextChallengeTime.startTime, tz)}** (UTC+{self._get_timezone_str(tz)})"
-			description += "  \n*" + data.eventSchedules.nodes[0].leagueMatchSetting.leagueMatchEvent.desc + "*"
-			description += "  \n" + self._stages_str(data.eventSchedules.nodes[0].leagueMatchSetting.vsStages)
-
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("splatoon3", tz, data, self._render_splatoon3)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("turf", help="Shows you the schedule of Turf War.")
+	@timed_command("turf")
 	async def turf(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		hasFest = False
-		for ii, node in enumerate(data.regularSchedules.nodes):
-			if not node.regularMatchSetting:
-				if not hasFest:
-					hasFest = True
-					description += "  \nLooks like a Splatfest is happening!"
-				continue
-			description += "\n\n"
-			if ii == 0:
-				description += "**Now**"
-			else:
-				description += "**" + self._iso_str(node.startTime, tz) + "**"
-			description += "  \n" + self._stages_str(node.regularMatchSetting.vsStages)
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("turf", tz, data, self._render_turf)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("anarchy", help="Shows you the schedules of Anarchy Battle.")
+	@timed_command("anarchy")
 	async def anarchy(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		hasFest = False
-		for ii, node in enumerate(data.bankaraSchedules.nodes):
-			if not node.bankaraMatchSettings:
-				if not hasFest:
-					hasFest = True
-					description += "  \nLooks like a Splatfest is happening!"
-				continue
-			description += "\n\n"
-			if ii == 0:
-				description += "**Now**"
-			else:
-				description += "**" + self._iso_str(node.startTime, tz) + "**"
-			description += "  \n" + self._stages_str(node.bankaraMatchSettings[0].vsStages)
-			description += " **" + node.bankaraMatchSettings[0].vsRule.name + "**"
-			description += "  \n" + self._stages_str(node.bankaraMatchSettings[1].vsStages)
-			description += " **" + node.bankaraMatchSettings[1].vsRule.name + "**"
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("anarchy", tz, data, self._render_anarchy)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("x", help="Shows you the schedule of X Battle.")
+	@timed_command("x")
 	async def x(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		hasFest = False
-		for ii, node in enumerate(data.xSchedules.nodes):
-			if not node.xMatchSetting:
-				if not hasFest:
-					hasFest = True
-					description += "  \nLooks like a Splatfest is happening!"
-				continue
-			description += "\n\n"
-			if ii == 0:
-				description += "**Now**"
-			else:
-				description += "**" + self._iso_str(node.startTime, tz) + "**"
-			description += "  \n" + self._stages_str(node.xMatchSetting.vsStages)
-			description += " **" + node.xMatchSetting.vsRule.name + "**"
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("x", tz, data, self._render_x)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("fest", help="Shows you the schedules of Splatfest Battle.")
+	@timed_command("fest")
 	async def fest(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		if data.currentFest:
-			# todo when splatfest happens
-			pass
-		hasFest = False
-		for ii, node in enumerate(data.festSchedules.nodes):
-			if node.festMatchSettings:
-				if not hasFest:
-					hasFest = True
-				description += "\n\n"
-				if ii == 0:
-					description += "**Now**"
-				else:
-					description += "**" + self._iso_str(node.startTime, tz) + "**"
-				description += "  \n" + self._stages_str(node.festMatchSettings[0].vsStages)
-				description += " **" + node.festMatchSettings[0].vsRule.name + "**"
-				description += "  \n" + self._stages_str(node.festMatchSettings[1].vsStages)
-				description += " **" + node.festMatchSettings[1].vsRule.name + "**"
-		if not hasFest:
-			description += "  \nIt doesn't look like there's any Splatfest battle soon."
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("fest", tz, data, self._render_fest)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("salmon", help="Shows you the schedule of Salmon Run.")
+	@timed_command("salmon")
 	async def salmon(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		for ii, node in enumerate(data.coopGroupingSchedule.regularSchedules.nodes):
-			description += "\n\n**" + self._iso_str(node.startTime, tz) + " - " + self._iso_str(node.endTime, tz) + "**"
-			if ii == 0:
-				if self._is_now_between_isos(node.startTime, node.endTime):
-					description += " **(Now!)**"
-			description += "  \n" + node.setting.coopStage.name + " | " + node.setting.boss.name
-			description += "  \n" + " / ".join(map(lambda w: w.name, node.setting.weapons))
-		await evt.reply(description)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("salmon", tz, data, self._render_salmon)
+		await evt.reply(description + self._stale_note(self.schedules))
 
 	@splatoon3.subcommand("challenge", help="Shows you the schedule of Challenge.")
+	@timed_command("challenge")
 	async def challenge(self, evt: MessageEvent) -> None:
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
+		data = await self.schedules.get()
+		if not data:
 			await evt.reply("Splatoon3.ink is currently down. Unable to fetch schedule data.")
 			return
-		data = dotdict(await resp.json()).data
-		tz = self._get_user_timezone((await evt.client.get_joined_members(evt.room_id))[evt.sender].displayname)
-		description = f"Note: The times are in UTC{self._get_timezone_str(tz)}"
-		for ii, node in enumerate(data.eventSchedules.nodes):
-			if len(node.timePeriods) < 0:
-				continue
-			nextTimeIndex = self._get_next_period_index(node.timePeriods)
-			description += "\n# " + node.leagueMatchSetting.leagueMatchEvent.name + "\n"
-			description += node.leagueMatchSetting.leagueMatchEvent.desc + "\n\n"
-			description += node.leagueMatchSetting.leagueMatchEvent.regulation + "\n\n"
-			description += "**" + self._iso_str(node.timePeriods[0].startTime, tz) + " - " + self._iso_str(node.timePeriods[-1].endTime, tz) + "**"
-			if ii == 0:
-				if self._is_now_between_isos(node.timePeriods[nextTimeIndex].startTime, node.timePeriods[nextTimeIndex].endTime):
-					description += " **(Now!)**"
-			description += "  \n" + self._stages_str(node.leagueMatchSetting.vsStages) + " **" + node.leagueMatchSetting.vsRule.name + "**"
-		await evt.reply(description, allow_html=True)
+		tz = await self._get_sender_timezone(evt)
+		description = self._get_reply("challenge", tz, data, self._render_challenge)
+		await evt.reply(description + self._stale_note(self.schedules), allow_html=True)
 
 	@splatoon3.subcommand("subscribe", help="Get notified when special events start. You can pass multiple arguments at once. Omitting arguments will unsubscribe the room from notifications. Valid events: festSoon, festStart, bigRunStart, challengeStart, challengeHappen")
 	@command.argument("events", required=False, pass_raw=True)
+	@timed_command("subscribe")
 	async def subscribe(self, evt: MessageEvent, events: str) -> None:
 		festSoon = False
 		festStart = False
@@ -262,7 +202,11 @@ class Splatoon3Plugin(Plugin):
 					eventStart = True
 				case "challengeHappen":
 					eventHappen = True
-		await self.dbm.subscribe(evt.room_id, festStart, bigRunStart, eventStart, eventHappen, festSoon)
+		if festSoon or festStart or bigRunStart or eventStart or eventHappen:
+			await self.registry.subscribe(evt.room_id, festStart, bigRunStart, eventStart, eventHappen, festSoon)
+		else:
+			# no events is how a room unsubscribes, don't keep an empty row around
+			await self.registry.unsubscribe(evt.room_id)
 		description = "Subscribed to "
 		if (not festStart) and (not bigRunStart) and (not eventStart):
 			description += "nothing."
@@ -282,8 +226,9 @@ class Splatoon3Plugin(Plugin):
 		await evt.reply(description)
 	
 	@splatoon3.subcommand("subscriptions", help="Check subscriptions of this room.")
+	@timed_command("subscriptions")
 	async def subscriptions(self, evt: MessageEvent) -> None:
-		sub = await self.dbm.getSubscription(evt.room_id)
+		sub = self.registry.get(evt.room_id)
 		festSoon = sub.fest_soon if sub else False
 		festStart = sub.fest_start if sub else False
 		bigRunStart = sub.bigrun_start if sub else False
@@ -307,16 +252,108 @@ class Splatoon3Plugin(Plugin):
 			description += ", ".join(things)
 		await evt.reply(description)
 	
+	@splatoon3.subcommand("timezone", help="Set the timezone times are shown in for you, e.g. Europe/London, +8 or -3:30. \"reset\" goes back to reading it from your display name. Omitting arguments shows your current timezone.")
+	@command.argument("zone", required=False)
+	@timed_command("timezone")
+	async def user_timezone(self, evt: MessageEvent, zone: str) -> None:
+		if not zone:
+			tz = await self._get_sender_timezone(evt)
+			source = "" if self.prefs.timezone(evt.sender) else " (from your display name)"
+			await evt.reply(f"Your timezone is **{timezone_label(tz)}**{source}.")
+			return
+		if zone.lower() == "reset":
+			await self.prefs.setTimezone(evt.sender, None)
+			await evt.reply("Your timezone will be read from your display name again.")
+			return
+		tz = normalize_timezone(zone)
+		if not tz:
+			await evt.reply("Unknown timezone. Use a name like **Europe/London** or an offset like **+8** or **-3:30**.")
+			return
+		await self.prefs.setTimezone(evt.sender, tz)
+		await evt.reply(f"Times will be shown in **{timezone_label(tz)}** for you.")
+
+	@splatoon3.subcommand("next", help="Shows you when a stage is next up in every mode.")
+	@command.argument("stage", pass_raw=True)
+	@timed_command("next")
+	async def next_stage(self, evt: MessageEvent, stage: str) -> None:
+		name = await self._find_stage(evt, stage)
+		if not name:
+			return
+		tz = await self._get_sender_timezone(evt)
+		now = datetime.now(timezone.utc)
+		# the first rotation of every mode, in the order they come up
+		firsts = dict()
+		for rotation in await self.dbm.getUpcomingRotations(name, now.strftime(ISO_FORMAT)):
+			firsts.setdefault(rotation.mode, rotation)
+		if not firsts:
+			await evt.reply(f"**{name}** isn't in any upcoming rotation.")
+			return
+		description = f"**{name}** is next up in:"
+		for rotation in firsts.values():
+			start = datetime.fromisoformat(rotation.start_time)
+			when = "**right now!**" if start <= now else "**" + self._time_str(start, tz) + "**"
+			description += "  \n" + self._mode_str(rotation.mode, rotation.rule) + ": " + when
+		description += f"  \nNote: The times are in {timezone_label(tz)}"
+		await evt.reply(description)
+
+	@splatoon3.subcommand("stats", help="Shows you how often a stage has been played in every mode.")
+	@command.argument("stage", pass_raw=True)
+	@timed_command("stats")
+	async def stage_stats(self, evt: MessageEvent, stage: str) -> None:
+		name = await self._find_stage(evt, stage)
+		if not name:
+			return
+		tz = await self._get_sender_timezone(evt)
+		stats = await self.dbm.getStageStats(name, datetime.now(timezone.utc).strftime(ISO_FORMAT))
+		if not stats:
+			await evt.reply(f"**{name}** hasn't been played since this bot started keeping track.")
+			return
+		first = min(stat.first for stat in stats)
+		description = f"**{name}** has been played {self._times_str(sum(stat.count for stat in stats))} since **{self._time_str(datetime.fromisoformat(first), tz)}**:"
+		for stat in stats:
+			description += f"  \n{self._mode_str(stat.mode, stat.rule)}: {self._times_str(stat.count)}, last on **{self._time_str(datetime.fromisoformat(stat.last), tz)}**"
+		description += f"  \nNote: The times are in {timezone_label(tz)}"
+		await evt.reply(description)
+
+	@splatoon3.subcommand("cache", help="Show hit/miss counters of the schedule cache.")
+	@timed_command("cache")
+	async def cache(self, evt: MessageEvent) -> None:
+		description = "**Cache statistics:**"
+		for name, cache in (("Schedules", self.schedules), ("Festivals", self.festivals)):
+			description += f"  \n{name}: {cache.hits} hits, {cache.misses} misses, {cache.fetches} fetches ({cache.notModified} not modified)"
+			if cache.stale:
+				description += ", **stale**"
+			if cache.expires:
+				description += ", expires at " + cache.expires.strftime("%m/%d %H:%M") + " (UTC+00:00)"
+		description += f"  \nReplies: {self.replies.hits} hits, {self.replies.misses} misses"
+		await evt.reply(description)
+
 	@splatoon3.subcommand("trigger", help="Trigger a rotation check.")
+	@timed_command("trigger")
 	async def trigger(self, evt: MessageEvent) -> None:
 		self.log.debug("Triggering rotation check")
 		await self._rotationUpdate()
 
+	@web.get("/metrics")
+	async def metrics_endpoint(self, req: Request) -> Response:
+		return Response(text=self.metrics.render(), headers={"Content-Type": CONTENT_TYPE})
+
 	@event.on(EventType.ROOM_TOMBSTONE)
 	async def tombstone(self, evt: StateEvent) -> None:
 		if not evt.content.replacement_room:
 			return
-		self.dbm.updateRoomId(evt.room_id, evt.content.replacement_room)
+		await self.registry.updateRoomId(evt.room_id, evt.content.replacement_room)
+
+	@event.on(EventType.ROOM_MEMBER)
+	async def member(self, evt: StateEvent) -> None:
+		members = self.displaynames.get(evt.room_id)
+		if members is None:
+			# nobody asked for anything in this room yet
+			return
+		if evt.content.membership == Membership.JOIN:
+			members[UserID(evt.state_key)] = evt.content.displayname or ""
+		else:
+			members.pop(UserID(evt.state_key), None)
 	
 	async def rotationUpdateLoop(self) -> None:
 		try:
@@ -326,180 +363,561 @@ class Splatoon3Plugin(Plugin):
 		except Exception:
 			self.log.exception("Fatal error while checking rotation")
 
-	async def _rotationUpdateLoop(self) -> None:
+	async def leaseLoop(self) -> None:
+		# only the instance holding the lease checks rotations, the others just answer commands
 		while True:
+			wasLeader = self.lease.isLeader
 			try:
-				await self._rotationUpdate()
+				await self.lease.acquire()
 			except asyncio.CancelledError:
-				self.log.debug("Checking stopped")
+				raise
 			except Exception:
-				self.log.exception("Fatal error while making rotation update notifs")
-			delta = timedelta(hours=1)
-			now = datetime.now()
-			nextHour = (now + delta).replace(microsecond=0, second=1, minute=0)
-			self.log.debug("Next rotation check will be run at " + nextHour.strftime("%H:%M:%S") + " which is " + str((nextHour - now).seconds) + " seconds away")
-			await asyncio.sleep((nextHour - now).seconds)
-
-	async def _rotationUpdate(self) -> None:
-		if datetime.now().hour % 2:
-			# hour is odd. no update
+				self.log.exception("Failed to renew the rotation checker lease")
+				self.lease.isLeader = False
+			if self.lease.isLeader != wasLeader:
+				self._set_leader(self.lease.isLeader)
+			await asyncio.sleep(RENEW_SECONDS)
+
+	def _set_leader(self, isLeader: bool) -> None:
+		self.schedules.readOnly = self.festivals.readOnly = not isLeader
+		if isLeader:
+			self.log.info("Checking rotations on this instance")
+			# check everything once, then only wake up when something is due
+			now = datetime.now(timezone.utc)
+			for kind in ALL:
+				self.scheduler.schedule(now, kind)
+		else:
+			self.log.info("Another instance is checking rotations")
+
+	async def _rotationUpdateLoop(self) -> None:
+		due = set()
+		while True:
+			# only the lease holder checks, leaseLoop wakes this up once we get the lease
+			if self.lease.isLeader:
+				if due & NOTIFY:
+					try:
+						await self._rotationUpdate(due)
+					except asyncio.CancelledError:
+						# the plugin is stopping, rotationUpdateLoop logs it
+						raise
+					except Exception:
+						self.log.exception("Fatal error while making rotation update notifs")
+				try:
+					await self._reschedule()
+				except asyncio.CancelledError:
+					raise
+				except Exception:
+					self.log.exception("Fatal error while scheduling rotation checks")
+			nextTime = self.scheduler.next_time()
+			if nextTime:
+				self.log.debug("Next rotation check will be run at " + nextTime.strftime("%m/%d %H:%M:%S") + " (UTC+00:00)")
+			await self.scheduler.wait()
+			due = self.scheduler.pop_due()
+
+	async def _reschedule(self) -> None:
+		now = datetime.now(timezone.utc)
+		# upstream is only asked again once the cached data runs out
+		data, _ = await asyncio.gather(self.schedules.get(wait=True), self.festivals.get(wait=True))
+		self.scheduler.schedule(self.schedules.expires or now + RETRY_DELAY, SCHEDULES)
+		if data:
+			for challenge in data.challenges:
+				for period in challenge.periods:
+					if period.start > now:
+						self.scheduler.schedule(period.start, CHALLENGE)
+			for node in data.big_run:
+				if node.start > now:
+					self.scheduler.schedule(node.start, BIG_RUN)
+		# new fests are looked for whenever the festivals data is refreshed
+		self.scheduler.schedule(self.festivals.expires or now + RETRY_DELAY, FEST)
+		for pastFest in await self.dbm.getUnreportedFests():
+			start = datetime.fromisoformat(pastFest.start_time)
+			if start > now:
+				self.scheduler.schedule(start, FEST)
+
+	async def _rotationUpdate(self, kinds: Set[str] = ALL) -> None:
+		self.log.debug("Checking rotation at " + datetime.now().strftime("%m/%d %H:%M") + " for " + ", ".join(sorted(kinds)))
+		# both endpoints are fetched at the same time, and one of them failing doesn't cancel the other's notifications
+		checks = dict()
+		# what each check claimed, and how to give it back if it can't be delivered
+		undo: dict[str, list[Callable[[], Awaitable]]] = dict()
+		if CHALLENGE in kinds:
+			checks[CHALLENGE] = self._check_challenge(undo.setdefault(CHALLENGE, list()))
+		if BIG_RUN in kinds:
+			checks[BIG_RUN] = self._check_big_run(undo.setdefault(BIG_RUN, list()))
+		if FEST in kinds:
+			checks[FEST] = self._check_fests(undo.setdefault(FEST, list()))
+		results = dict(zip(checks.keys(), await asyncio.gather(*checks.values(), return_exceptions=True)))
+		for kind, result in results.items():
+			if isinstance(result, Exception):
+				self.log.error(f"Failed to check {kind} notifications", exc_info=result)
+				await self._release(kind, undo.pop(kind))
+		# whatever is over can't be notified about again, so its claim isn't needed anymore
+		await self.dbm.pruneNotifications(datetime.now(timezone.utc).strftime(ISO_FORMAT))
+		challengeStartStr, challengeHappenStr = "", ""
+		if isinstance(results.get(CHALLENGE), tuple):
+			challengeStartStr, challengeHappenStr = results[CHALLENGE]
+
+		bigRunStr = results.get(BIG_RUN)
+		if not isinstance(bigRunStr, str):
+			bigRunStr = ""
+
+		festSoonStr, festSoonStrs, festSoonImgs = "", list(), list()
+		festStartStr, festStartStrs, festStartImgs = "", list(), list()
+		if isinstance(results.get(FEST), tuple):
+			(festSoonStr, festSoonStrs, festSoonImgs), (festStartStr, festStartStrs, festStartImgs) = results[FEST]
+
+		# only the rooms that want one of this run's messages
+		events = set()
+		if challengeStartStr:
+			events.update(("event_start", "event_happen"))
+		if challengeHappenStr:
+			events.add("event_happen")
+		if bigRunStr:
+			events.add("bigrun_start")
+		if festSoonStr:
+			events.add("fest_soon")
+		if festStartStr:
+			events.add("fest_start")
+		# everything a room gets in this run, in order. rooms that want the same things share one message
+		rooms: dict[tuple[tuple[str, str], ...], list[RoomID]] = dict()
+		for sub in self.registry.rooms(events):
+			parts = list()
+			if challengeStartStr and (sub.event_start or sub.event_happen):
+				parts.append((TEXT_PART, challengeStartStr))
+			# one challenge can start while another one's later period begins, those rooms get both
+			if challengeHappenStr and sub.event_happen:
+				parts.append((TEXT_PART, challengeHappenStr))
+			if bigRunStr and sub.bigrun_start:
+				parts.append((TEXT_PART, bigRunStr))
+			if festSoonStr and sub.fest_soon:
+				parts.append((TEXT_PART, festSoonStr))
+				for ii in range(len(festSoonStrs)):
+					parts.append((TEXT_PART, festSoonStrs[ii]))
+					parts.append((IMAGE_PART, festSoonImgs[ii]))
+			if festStartStr and sub.fest_start:
+				parts.append((TEXT_PART, festStartStr))
+				for ii in range(len(festStartStrs)):
+					parts.append((TEXT_PART, festStartStrs[ii]))
+					parts.append((IMAGE_PART, festStartImgs[ii]))
+			if parts:
+				rooms.setdefault(tuple(parts), list()).append(sub.room_id)
+		if not rooms:
 			return
-		self.log.debug("Checking rotation at " + datetime.now().strftime("%m/%d %H:%M"))
-		resp = await self.http.get("https://splatoon3.ink/data/schedules.json")
-		if not resp.ok:
-			self.log.info("Splatoon3.ink is currently down. Unable to fetch schedule data.")
+		try:
+			# upload every image before composing
+			await asyncio.gather(*(self.media.get(url) for url in festSoonImgs + festStartImgs if url), return_exceptions=True)
+			rendered = dict()
+			jobs: dict[RoomID, list[Send]] = dict()
+			for parts, roomIds in rooms.items():
+				content = await self._compose(parts, rendered)
+				for roomId in roomIds:
+					jobs[roomId] = [partial(self.client.send_message_event, roomId, EventType.ROOM_MESSAGE, content)]
+			delivery = Delivery(self.log, self.config["notifications.parallelism"], self.config["notifications.retries"], self.config["notifications.backoff"])
+			self.lastDelivery = await delivery.run(jobs)
+		except Exception:
+			for kind, claims in undo.items():
+				await self._release(kind, claims)
+			raise
+		if self.lastDelivery.messages == 0:
+			# not a single room got it, most likely the homeserver is down. some rooms failing doesn't count,
+			# the others would get it twice
+			self.log.warning("No rotation update could be delivered, trying again later")
+			for kind, claims in undo.items():
+				await self._release(kind, claims)
+		self.metrics.histogram("notification_fanout_duration_seconds", "Time taken to deliver a rotation update to every subscribed room.").observe(self.lastDelivery.duration)
+		notifications = self.metrics.counter("notifications_total", "Rotation update messages, by outcome.")
+		notifications.inc(self.lastDelivery.messages, outcome="sent")
+		notifications.inc(self.lastDelivery.failed, outcome="failed")
+		notifications.inc(self.lastDelivery.retries, outcome="retried")
+		self.log.info("Delivered rotation updates: " + self.lastDelivery.summary())
+
+
+	async def _release(self, kind: str, claims: list[Callable[[], Awaitable]]) -> None:
+		# gives back what a check claimed so the next check announces it again
+		if not claims:
 			return
-		data = dotdict(await resp.json()).data
+		for release in claims:
+			try:
+				await release()
+			except Exception:
+				self.log.exception(f"Failed to release a {kind} notification")
+		self.scheduler.schedule(datetime.now(timezone.utc) + RETRY_DELAY, kind)
+
+	async def _archive(self, data: Schedules) -> None:
+		# every schedules document this instance sees goes into the history, whoever fetched it
+		try:
+			await self.history.archive(data)
+		except Exception:
+			self.log.exception("Failed to archive rotations")
+
+	async def _check_challenge(self, undo: list[Callable[[], Awaitable]]) -> tuple[str, str]:
 		challengeStartStr = ""
-		node = data.eventSchedules.nodes[0]
-		if self._is_now_between_isos(node.timePeriods[0].startTime, node.timePeriods[0].endTime):
-			self.log.debug("challenge starting")
-			challengeStartStr = f"# {node.leagueMatchSetting.leagueMatchEvent.name}"
-			challengeStartStr += "\nis starting its first rotation **right now!**  \n"
-			challengeStartStr += node.leagueMatchSetting.leagueMatchEvent.desc + "\n\n"
-			challengeStartStr += node.leagueMatchSetting.leagueMatchEvent.regulation + "\n\n"
-			challengeStartStr += "**" + self._iso_str(node.timePeriods[0].startTime) + " - " + self._iso_str(node.timePeriods[-1].endTime) + "** (UTC+00:00)"
-			challengeStartStr += "  \n" + self._stages_str(node.leagueMatchSetting.vsStages) + " **" + node.leagueMatchSetting.vsRule.name + "**"
-		
 		challengeHappenStr = ""
-		if not challengeStartStr:
-			nextTimeIndex = self._get_next_period_index(node.timePeriods)
-			if self._is_now_between_isos(node.timePeriods[nextTimeIndex].startTime, node.timePeriods[nextTimeIndex].endTime):
-				self.log.debug("challenge happening")
-				challengeHappenStr = f"# {node.leagueMatchSetting.leagueMatchEvent.name}"
-				challengeHappenStr += "\nis happening **right now!**  \n"
-				challengeHappenStr += node.leagueMatchSetting.leagueMatchEvent.desc + "\n\n"
-				challengeHappenStr += node.leagueMatchSetting.leagueMatchEvent.regulation + "\n\n"
-				challengeHappenStr += "**" + self._iso_str(node.timePeriods[nextTimeIndex].startTime) + " - " + self._iso_str(node.timePeriods[nextTimeIndex].endTime) + "** (UTC+00:00)"
-				challengeHappenStr += "  \n" + self._stages_str(node.leagueMatchSetting.vsStages) + " **" + node.leagueMatchSetting.vsRule.name + "**"
-
-		# todo make bigRunStr when big run happens
+		data = await self.schedules.get(wait=True)
+		if not data:
+			self.log.info("Splatoon3.ink is currently down. Unable to fetch schedule data.")
+			return "", ""
+		for node in data.challenges:
+			for ii, period in enumerate(node.periods):
+				if not self._is_now_between(period.start, period.end):
+					continue
+				# only periods nobody was told about yet, even across restarts and missed checks
+				entity = node.event.id + "/" + period.start.strftime(ISO_FORMAT)
+				if not await self.dbm.claimNotification(CHALLENGE, entity, period.end.strftime(ISO_FORMAT)):
+					continue
+				undo.append(partial(self.dbm.releaseNotification, CHALLENGE, entity))
+				if ii == 0:
+					self.log.debug("challenge starting")
+					if challengeStartStr:
+						challengeStartStr += "\n\n"
+					challengeStartStr += f"# {node.event.name}"
+					challengeStartStr += "\nis starting its first rotation **right now!**  \n"
+					challengeStartStr += node.event.desc + "\n\n"
+					challengeStartStr += node.event.regulation + "\n\n"
+					challengeStartStr += "**" + self._time_str(node.periods[0].start) + " - " + self._time_str(node.periods[-1].end) + "** (UTC+00:00)"
+					challengeStartStr += "  \n" + self._stages_str(node.setting.stages) + " **" + node.setting.rule.name + "**"
+				else:
+					self.log.debug("challenge happening")
+					if challengeHappenStr:
+						challengeHappenStr += "\n\n"
+					challengeHappenStr += f"# {node.event.name}"
+					challengeHappenStr += "\nis happening **right now!**  \n"
+					challengeHappenStr += node.event.desc + "\n\n"
+					challengeHappenStr += node.event.regulation + "\n\n"
+					challengeHappenStr += "**" + self._time_str(period.start) + " - " + self._time_str(period.end) + "** (UTC+00:00)"
+					challengeHappenStr += "  \n" + self._stages_str(node.setting.stages) + " **" + node.setting.rule.name + "**"
+		return challengeStartStr, challengeHappenStr
+
+	async def _check_big_run(self, undo: list[Callable[[], Awaitable]]) -> str:
 		bigRunStr = ""
-
+		data = await self.schedules.get(wait=True)
+		if not data:
+			self.log.info("Splatoon3.ink is currently down. Unable to fetch schedule data.")
+			return ""
+		for node in data.big_run:
+			if not self._is_now_between(node.start, node.end):
+				continue
+			if not await self.dbm.claimNotification(BIG_RUN, node.start.strftime(ISO_FORMAT), node.end.strftime(ISO_FORMAT)):
+				continue
+			undo.append(partial(self.dbm.releaseNotification, BIG_RUN, node.start.strftime(ISO_FORMAT)))
+			self.log.debug("big run starting")
+			if bigRunStr:
+				bigRunStr += "\n\n"
+			bigRunStr += "# Big Run"
+			bigRunStr += "\nis happening **right now!**  \n"
+			bigRunStr += "**" + self._time_str(node.start) + " - " + self._time_str(node.end) + "** (UTC+00:00)"
+			bigRunStr += "  \n" + node.setting.stage.name + (" | " + node.setting.boss if node.setting.boss else "")
+			bigRunStr += "  \n" + " / ".join(node.setting.weapons)
+		return bigRunStr
+
+	async def _check_fests(self, undo: list[Callable[[], Awaitable]]) -> tuple[tuple[str, list[str], list[str]], tuple[str, list[str], list[str]]]:
 		# ongoing splatfest check
 		festSoonStrs = list()
 		festSoonImgs = list()
 		festSoonStr = ""
-		resp = await self.http.get("https://splatoon3.ink/data/festivals.json")
-		if not resp.ok:
+		festStartStrs = list()
+		festStartImgs = list()
+		festStartStr = ""
+		data = await self.festivals.get(wait=True)
+		if not data:
 			self.log.info("Splatoon3.ink is currently down. Unable to fetch festivals data.")
-			return
-		data = dotdict(await resp.json())
-		pastFests = await self.dbm.getPastFests()
-		ids = list(map(lambda x: x.fest_id, pastFests))
-		for region in data.keys():
-			node = dotdict(data[region]).data.festRecords.nodes[0]
-			if node["__splatoon3ink_id"] in ids or node.state != "SCHEDULED":
+			return ("", list(), list()), ("", list(), list())
+		ids = await self.dbm.getKnownFestIds([fest.id for fest in data.latest])
+		for fest in data.latest:
+			if fest.id in ids or fest.state != "SCHEDULED":
 				continue
-			ids.append(node["__splatoon3ink_id"])
-			await self.dbm.addFest(node["__splatoon3ink_id"], node.startTime)
+			ids.add(fest.id)
+			await self.dbm.addFest(fest.id, fest.start.strftime(ISO_FORMAT))
+			undo.append(partial(self.dbm.forgetFest, fest.id))
 			if not festSoonStr:
 				festSoonStr += "Splatfest happening soon! You can vote now!"
-			indFestSoonStr = f"# {node.title}\n"
-			indFestSoonStr += "This Splatfest will happen on **" + self._iso_str(node.startTime) + "** - **" + self._iso_str(node.endTime) + "**  \n"
-			indFestSoonStr += "Teams: **" + "** | **".join(list(map(lambda team: team.teamName, node.teams))) + "**"
+			indFestSoonStr = f"# {fest.title}\n"
+			indFestSoonStr += "This Splatfest will happen on **" + self._time_str(fest.start) + "** - **" + self._time_str(fest.end) + "**  \n"
+			indFestSoonStr += "Teams: **" + "** | **".join(fest.teams) + "**"
 			festSoonStrs.append(indFestSoonStr)
-			festSoonImgs.append(node.image.url)
+			festSoonImgs.append(fest.image)
 
 		# splatfest start check
-		festStartStrs = list()
-		festStartImgs = list()
-		festStartStr = ""
-		for pastFest in pastFests:
-			if self._is_now_after_iso(pastFest.start_time) and not pastFest.reported:
-				for region in data.keys():
-					node = dotdict(data[region]).data.festRecords.nodes[0]
-					if node["__splatoon3ink_id"] == pastFest.fest_id:
-						if not festStartStr:
-							festStartStr = "Splatfest is happening!"
-						indFestStartStr = f"# {node.title}\n"
-						indFestStartStr += "This Splatfest is going from **" + self._iso_str(node.startTime) + "** to **" + self._iso_str(node.endTime) + "**  \n"
-						indFestStartStr += "Teams: **" + "** | **".join(list(map(lambda team: team.teamName, node.teams))) + "**"
-						festStartStrs.append(indFestStartStr)
-						festStartImgs.append(node.image.url)
-						await self.dbm.markFestReported(pastFest.fest_id)
-						break
-
-
-		subs = await self.dbm.getSubscriptions()
-		for sub in subs:
-			if challengeStartStr and (sub.event_start or sub.event_happen):
-				await self._send_rotation_update(sub.room_id, challengeStartStr)
-			elif challengeHappenStr and sub.event_happen:
-				await self._send_rotation_update(sub.room_id, challengeHappenStr)
-			
-			if festSoonStr and sub.fest_soon:
-				await self._send_rotation_update(sub.room_id, festSoonStr)
-				for ii in range(len(festSoonStrs)):
-					await self._send_rotation_update(sub.room_id, festSoonStrs[ii])
-					await self._send_rotation_image(sub.room_id, festSoonImgs[ii])
-			if festStartStr and sub.fest_start:
-				await self._send_rotation_update(sub.room_id, festStartStr)
-				for ii in range(len(festStartStrs)):
-					await self._send_rotation_update(sub.room_id, festStartStrs[ii])
-					await self._send_rotation_image(sub.room_id, festStartImgs[ii])
-
+		now = datetime.now(timezone.utc)
+		latest = {fest.id: fest for fest in data.latest}
+		for pastFest in await self.dbm.getStartedFests(now.strftime(ISO_FORMAT)):
+			fest = latest.get(pastFest.fest_id)
+			if not fest:
+				continue
+			if not festStartStr:
+				festStartStr = "Splatfest is happening!"
+			indFestStartStr = f"# {fest.title}\n"
+			indFestStartStr += "This Splatfest is going from **" + self._time_str(fest.start) + "** to **" + self._time_str(fest.end) + "**  \n"
+			indFestStartStr += "Teams: **" + "** | **".join(fest.teams) + "**"
+			festStartStrs.append(indFestStartStr)
+			festStartImgs.append(fest.image)
+			await self.dbm.markFestReported(pastFest.fest_id)
+			undo.append(partial(self.dbm.markFestReported, pastFest.fest_id, False))
+
+		# old fests can't come back as scheduled, so there's no need to remember them forever
+		await self.dbm.pruneFests((now - timedelta(days=self.config["fests.retention_days"])).strftime(ISO_FORMAT))
+		return (festSoonStr, festSoonStrs, festSoonImgs), (festStartStr, festStartStrs, festStartImgs)
+
+	def _render_splatoon3(self, data: Schedules, tz: str) -> str:
+		description = "**Current rotation:**"
+		if data.regular and data.regular[0].settings:
+			setting = data.regular[0].settings[0]
+			description += "  \nTurf War: " + self._stages_str(setting.stages)
+		if data.bankara and data.bankara[0].settings:
+			setting = data.bankara[0].settings[0]
+			description += "  \n" + setting.rule.name + " (Series): " + self._stages_str(setting.stages)
+			setting = data.bankara[0].settings[1]
+			description += "  \n" + setting.rule.name + " (Open): " + self._stages_str(setting.stages)
+		if data.x and data.x[0].settings:
+			setting = data.x[0].settings[0]
+			description += "  \n" + setting.rule.name + " (X): " + self._stages_str(setting.stages)
+		if data.current_fest:
+			# todo when splatfest happens
+			pass
+		if data.fest and data.fest[0].settings:
+			setting = data.fest[0].settings[0]
+			description += "  \nSplatfest (Open): " + self._stages_str(setting.stages)
+			setting = data.fest[0].settings[1]
+			description += "  \nSplatfest (Pro): " + self._stages_str(setting.stages)
+
+		if len(data.salmon) > 0:
+			setting = data.salmon[0].setting
+			description += "\n\n**Salmon Run:**  \n" + setting.stage.name + " | " + setting.boss + "  \n"
+			description += " / ".join(setting.weapons)
+		if len(data.big_run) > 0:
+			# todo when big run happens
+			pass
+		if len(data.eggstra) > 0:
+			# todo when eggstra work happens
+			pass
 
-	def _stages_str(self, vsStages: list[dotdict]) -> str:
-		return " | ".join(map(lambda x: x.name, vsStages))
+		if data.challenges and len(data.challenges[0].periods) > 0:
+			challenge = data.challenges[0]
+			nextChallengeTime = challenge.periods[self._get_next_period_index(challenge.periods)]
+			description += "\n\n**" + challenge.event.name + "** "
+			if self._is_now_between(nextChallengeTime.start, nextChallengeTime.end):
+				description += "is happening **right now!**"
+			else:
+				description += f"will happen on **{self._time_str(nextChallengeTime.start, tz)}** ({timezone_label(tz)})"
+			description += "  \n*" + challenge.event.desc + "*"
+			description += "  \n" + self._stages_str(challenge.setting.stages)
 
-	def _iso_str(self, iso: str, tz_offset: int = 0) -> str:
-		return (datetime.fromisoformat(iso).replace(tzinfo=timezone.utc) + timedelta(hours=tz_offset)).strftime("%m/%d %H:%M")
+		return description
 
-	def _is_now_between_isos(self, start: str, end: str) -> bool:
-		return datetime.fromisoformat(start) < datetime.utcnow().replace(tzinfo=timezone.utc) < datetime.fromisoformat(end)
+	def _render_turf(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		hasFest = False
+		for ii, node in enumerate(data.regular):
+			if not node.settings:
+				if not hasFest:
+					hasFest = True
+					description += "  \nLooks like a Splatfest is happening!"
+				continue
+			description += "\n\n"
+			if ii == 0:
+				description += "**Now**"
+			else:
+				description += "**" + self._time_str(node.start, tz) + "**"
+			description += "  \n" + self._stages_str(node.settings[0].stages)
+		return description
 
-	def _is_now_after_iso(self, start: str) -> bool:
-		return datetime.fromisoformat(start) < datetime.utcnow().replace(tzinfo=timezone.utc)
+	def _render_anarchy(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		hasFest = False
+		for ii, node in enumerate(data.bankara):
+			if not node.settings:
+				if not hasFest:
+					hasFest = True
+					description += "  \nLooks like a Splatfest is happening!"
+				continue
+			description += "\n\n"
+			if ii == 0:
+				description += "**Now**"
+			else:
+				description += "**" + self._time_str(node.start, tz) + "**"
+			description += "  \n" + self._stages_str(node.settings[0].stages)
+			description += " **" + node.settings[0].rule.name + "**"
+			description += "  \n" + self._stages_str(node.settings[1].stages)
+			description += " **" + node.settings[1].rule.name + "**"
+		return description
+
+	def _render_x(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		hasFest = False
+		for ii, node in enumerate(data.x):
+			if not node.settings:
+				if not hasFest:
+					hasFest = True
+					description += "  \nLooks like a Splatfest is happening!"
+				continue
+			description += "\n\n"
+			if ii == 0:
+				description += "**Now**"
+			else:
+				description += "**" + self._time_str(node.start, tz) + "**"
+			description += "  \n" + self._stages_str(node.settings[0].stages)
+			description += " **" + node.settings[0].rule.name + "**"
+		return description
+
+	def _render_fest(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		if data.current_fest:
+			# todo when splatfest happens
+			pass
+		hasFest = False
+		for ii, node in enumerate(data.fest):
+			if node.settings:
+				if not hasFest:
+					hasFest = True
+				description += "\n\n"
+				if ii == 0:
+					description += "**Now**"
+				else:
+					description += "**" + self._time_str(node.start, tz) + "**"
+				description += "  \n" + self._stages_str(node.settings[0].stages)
+				description += " **" + node.settings[0].rule.name + "**"
+				description += "  \n" + self._stages_str(node.settings[1].stages)
+				description += " **" + node.settings[1].rule.name + "**"
+		if not hasFest:
+			description += "  \nIt doesn't look like there's any Splatfest battle soon."
+		return description
 
-	async def _send_rotation_update(self, roomId: RoomID, text: str) -> None:
-		content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=text)
+	def _render_salmon(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		for ii, node in enumerate(data.salmon):
+			description += "\n\n**" + self._time_str(node.start, tz) + " - " + self._time_str(node.end, tz) + "**"
+			if ii == 0:
+				if self._is_now_between(node.start, node.end):
+					description += " **(Now!)**"
+			description += "  \n" + node.setting.stage.name + " | " + node.setting.boss
+			description += "  \n" + " / ".join(node.setting.weapons)
+		return description
+
+	def _render_challenge(self, data: Schedules, tz: str) -> str:
+		description = f"Note: The times are in {timezone_label(tz)}"
+		for ii, node in enumerate(data.challenges):
+			if not node.periods:
+				continue
+			nextTimeIndex = self._get_next_period_index(node.periods)
+			description += "\n# " + node.event.name + "\n"
+			description += node.event.desc + "\n\n"
+			description += node.event.regulation + "\n\n"
+			description += "**" + self._time_str(node.periods[0].start, tz) + " - " + self._time_str(node.periods[-1].end, tz) + "**"
+			if ii == 0:
+				if self._is_now_between(node.periods[nextTimeIndex].start, node.periods[nextTimeIndex].end):
+					description += " **(Now!)**"
+			description += "  \n" + self._stages_str(node.setting.stages) + " **" + node.setting.rule.name + "**"
+		return description
+
+	def _get_reply(self, subcommand: str, tz: str, data: Schedules, render: Callable[[Schedules, str], str]) -> str:
+		# replies only change with the data, the rotation and the timezone, so render each combination once
+		return self.replies.get((subcommand, tz), (self.schedules.generation, self._rotation_id()), lambda: render(data, tz))
+
+	def _rotation_id(self) -> int:
+		# rotations change every 2 hours on even UTC hours
+		return int(datetime.now(timezone.utc).timestamp()) // ROTATION_SECONDS
+
+	def _register_metrics(self) -> None:
+		# the caches count these anyway, they're only read when the metrics are scraped
+		caches = (self.schedules, self.festivals)
+		self.metrics.counter("upstream_cache_hits_total", "Upstream documents answered from the cache.", lambda: (({"url": cache.url}, cache.hits) for cache in caches))
+		self.metrics.counter("upstream_cache_misses_total", "Upstream documents that had to be revalidated.", lambda: (({"url": cache.url}, cache.misses) for cache in caches))
+		self.metrics.counter("upstream_not_modified_total", "Revalidations upstream answered with 304 Not Modified.", lambda: (({"url": cache.url}, cache.notModified) for cache in caches))
+		self.metrics.counter("reply_cache_hits_total", "Replies answered without rendering.", lambda: (({}, self.replies.hits),))
+		self.metrics.counter("reply_cache_misses_total", "Replies that had to be rendered.", lambda: (({}, self.replies.misses),))
+		self.metrics.gauge("media_cached", "Uploaded images kept in memory.", lambda: (({}, len(self.media.known)),))
+		self.metrics.gauge("subscribed_rooms", "Rooms with a subscription.", lambda: (({}, len(self.registry.byRoom)),))
+
+	def _stale_note(self, cache: UpstreamCache) -> str:
+		if not cache.stale or not cache.fetchedAt:
+			return ""
+		return "\n\n*Splatoon3.ink is currently down. Showing cached data from " + cache.fetchedAt.strftime("%m/%d %H:%M") + " (UTC+00:00).*"
+
+	def _mode_str(self, mode: str, rule: str) -> str:
+		name = MODE_NAMES.get(mode, mode)
+		return name + " - " + rule if rule and rule != "Turf War" else name
+
+	def _times_str(self, count: int) -> str:
+		return "once" if count == 1 else f"{count} times"
+
+	async def _find_stage(self, evt: MessageEvent, query: str) -> str | None:
+		# replies itself when the query doesn't name exactly one stage
+		stages = await self.history.find_stage(query)
+		if len(stages) == 1:
+			return stages[0]
+		if not stages:
+			await evt.reply("No stage matches that name. Stages only show up once they've been in a rotation.")
+		else:
+			await evt.reply("Which one? " + ", ".join(stages))
+		return None
+
+	def _stages_str(self, stages: list[Stage]) -> str:
+		return " | ".join(map(lambda x: x.name, stages))
+
+	def _time_str(self, time: datetime, tz: str = UTC) -> str:
+		return time.astimezone(get_tzinfo(tz)).strftime("%m/%d %H:%M")
+
+	def _is_now_between(self, start: datetime, end: datetime) -> bool:
+		return start < datetime.now(timezone.utc) < end
+
+	async def _compose(self, parts: tuple[tuple[str, str], ...], rendered: dict[str, tuple[str, str]]) -> TextMessageEventContent:
+		# one notice for everything, with the images inline. markdown is rendered once per run, not once per room
+		bodies = list()
+		htmls = list()
+		for kind, value in parts:
+			if kind == TEXT_PART:
+				if value not in rendered:
+					rendered[value] = await parse_formatted(value, render_markdown=True, allow_html=True)
+				body, html = rendered[value]
+				bodies.append(body)
+				htmls.append(html)
+				continue
+			try:
+				media = await self.media.get(value)
+			except Exception:
+				# e.g. the upload failed, the notice goes out without the image
+				self.log.exception("Failed to upload image: " + value)
+				continue
+			if not media:
+				self.log.info("Failed to fetch image: " + value)
+				continue
+			# the thumbnail is plenty for an image inside a message, and a lot less for every client to download
+			mxc, width, height = media.mxc, media.width, media.height
+			if media.thumbnail_mxc:
+				mxc, width, height = media.thumbnail_mxc, media.thumbnail_width, media.thumbnail_height
+			# fit the image in the message, clients scale it down further if they need to
+			scale = min(1, INLINE_IMAGE_SIZE / max(width, height, 1))
+			htmls.append(f'<img src="{mxc}" alt="{self.media.filename(media)}" width="{round(width * scale)}" height="{round(height * scale)}">')
+		content = TextMessageEventContent(msgtype=MessageType.NOTICE, body="\n\n".join(bodies))
 		content.format = Format.HTML
-		content.body, content.formatted_body = await parse_formatted(
-			content.body, render_markdown=True, allow_html=True
-		)
-		await self.client.send_message_event(roomId, EventType.ROOM_MESSAGE, content)
-
-	async def _send_rotation_image(self, roomId: RoomID, url: str) -> None:
-		info = ImageInfo()
-		# fetch the image
-		resp = await self.http.get(url)
-		if not resp.ok:
-			self.log.info("Failed to fetch image: " + url)
-			return
-		img = Image.open(io.BytesIO(await resp.read()))
-		imgByteArr = io.BytesIO()
-		img.save(imgByteArr, format="PNG")
-		imgByteArr = imgByteArr.getvalue()
-		# write image info
-		info.mimetype = "image/png"
-		info.size = len(imgByteArr)
-		info.width, info.height = img.size
-		# upload image
-		url = await self.client.upload_media(imgByteArr, info.mimetype, "rot.png")
-		# send image
-		await self.client.send_message_event(roomId, EventType.ROOM_MESSAGE, MediaMessageEventContent(url=url, info=info, body="rot.png", msgtype=MessageType.IMAGE))
-
-	def _get_next_period_index(self, timePeriods: list[dotdict]) -> int:
+		content.formatted_body = "".join(htmls)
+		return content
+
+	def _get_next_period_index(self, timePeriods: list[TimePeriod]) -> int:
 		nextTimeIndex = 0
 		for jj in range(len(timePeriods) - 1):
-			if self._is_now_between_isos(timePeriods[jj].endTime, timePeriods[jj+1].endTime):
+			if self._is_now_between(timePeriods[jj].end, timePeriods[jj+1].end):
 				nextTimeIndex = jj+1
 				break
 		return nextTimeIndex
 
-	def _get_user_timezone(self, name: str) -> int:
-		matches = re.findall(r"((\+?|-)\d{1,2})(:\d{2})?", name)
-		if not matches or len(matches) == 0 or len(matches[-1]) == 0:
-			return 0
-		timezone = 0
+	async def _get_sender_timezone(self, evt: MessageEvent) -> str:
+		# a timezone set with the timezone command is a plain dict lookup
+		tz = self.prefs.timezone(evt.sender)
+		if tz:
+			return tz
+		return displayname_timezone(await self._get_displayname(evt.room_id, evt.sender))
+
+	async def _get_displayname(self, roomId: RoomID, userId: UserID) -> str:
+		# kept up to date by the member event handler, so only the first lookup per user hits the homeserver
+		members = self.displaynames.setdefault(roomId, dict())
+		name = members.get(userId)
+		if name is not None:
+			return name
 		try:
-			timezone = int(matches[-1][0])
-		except ValueError as verr:
-			pass
-		except Exception as ex:
-			pass
-		return timezone
-
-	def _get_timezone_str(self, tz: int) -> str:
-		return ("+" if tz >= 0 else "-") + str(tz).zfill(2) + ":00"
\ No newline at end of file
+			member = await self.client.get_state_event(roomId, EventType.ROOM_MEMBER, userId)
+			name = member.displayname or ""
+		except MatrixRequestError:
+			name = ""
+		members[userId] = name
+		return name
@@ -0,0 +1,260 @@
+from __future__ import annotations
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import json
+import re
+import time
+from typing import Any, Awaitable, Callable, Hashable
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from .db import DBManager
+from .metrics import SIZE_BUCKETS, Metrics
+
+SCHEDULES_URL = "https://splatoon3.ink/data/schedules.json"
+FESTIVALS_URL = "https://splatoon3.ink/data/festivals.json"
+
+# rotations change every 2 hours
+ROTATION_SECONDS = 2 * 60 * 60
+
+# how long to wait before asking again when upstream is down or hasn't rolled over yet
+RETRY_DELAY = timedelta(minutes=1)
+
+def schedules_boundary(data: dict) -> datetime | None:
+	# the schedule changes when the current regular rotation ends
+	try:
+		return datetime.fromisoformat(data["data"]["regularSchedules"]["nodes"][0]["endTime"])
+	except (KeyError, IndexError, TypeError, ValueError):
+		return None
+
+class UpstreamCache:
+	# keeps the last response of a splatoon3.ink endpoint in memory (and in the database)
+	# until the rotation it describes is over (or its HTTP freshness runs out)
+	http: ClientSession
+	url: str
+	dbm: DBManager | None
+	boundary: Callable[[dict], datetime | None] | None
+	parse: Callable[[Any], Any] | None
+	metrics: Metrics | None
+	# called with every new model, whether fetched or loaded from the database. must not raise
+	onChange: Callable[[Any], Awaitable] | None
+	fallbackTtl: timedelta
+	# another instance keeps the database copy fresh, read that before asking upstream
+	readOnly: bool
+	timeout: ClientTimeout
+	# only the parsed document is kept, the raw one is dropped once the boundary is known
+	model: Any
+	boundaryAt: datetime | None
+	etag: str | None
+	lastModified: str | None
+	expires: datetime | None
+	fetchedAt: datetime | None
+	stale: bool
+	hits: int
+	misses: int
+	fetches: int
+	notModified: int
+	# bumped whenever a new document replaces the cached one
+	generation: int
+	_fetching: asyncio.Task | None
+
+	def __init__(self, http: ClientSession, url: str, dbm: DBManager | None = None, boundary: Callable[[dict], datetime | None] | None = None, parse: Callable[[Any], Any] | None = None, fallbackTtl: timedelta = timedelta(hours=1), timeout: float = 10, metrics: Metrics | None = None, onChange: Callable[[Any], Awaitable] | None = None) -> None:
+		self.http = http
+		self.url = url
+		self.dbm = dbm
+		self.boundary = boundary
+		self.parse = parse
+		self.fallbackTtl = fallbackTtl
+		self.readOnly = False
+		# a slow endpoint gives up on its own instead of holding up everything waiting on it
+		self.timeout = ClientTimeout(total=timeout)
+		self.metrics = metrics
+		self.onChange = onChange
+		self.model = None
+		self.boundaryAt = None
+		self.etag = None
+		self.lastModified = None
+		self.expires = None
+		self.fetchedAt = None
+		self.stale = False
+		self.hits = 0
+		self.misses = 0
+		self.fetches = 0
+		self.notModified = 0
+		self.generation = 0
+		self._fetching = None
+
+	async def load(self, onlyFresh: bool = False) -> bool:
+		# restore the last good payload so a restart doesn't need upstream to be up
+		if not self.dbm:
+			return False
+		cached = await self.dbm.getCachedResponse(self.url)
+		if not cached:
+			return False
+		expires = datetime.fromisoformat(cached.expires)
+		if onlyFresh and expires <= datetime.now(timezone.utc):
+			return False
+		try:
+			model, boundaryAt = self._parse(cached.body)
+		except (KeyError, TypeError, ValueError):
+			return False
+		self.model = model
+		self.boundaryAt = boundaryAt
+		self.generation += 1
+		self.etag = cached.etag
+		self.lastModified = cached.last_modified
+		self.fetchedAt = datetime.fromisoformat(cached.fetched_at)
+		self.expires = expires
+		if self.onChange:
+			await self.onChange(model)
+		return True
+
+	def is_fresh(self) -> bool:
+		return self.model is not None and self.expires is not None and datetime.now(timezone.utc) < self.expires
+
+	def is_current(self) -> bool:
+		# whether the cached document still describes the ongoing rotation
+		if self.model is None:
+			return False
+		return not self.boundaryAt or datetime.now(timezone.utc) < self.boundaryAt
+
+	async def get(self, wait: bool = False) -> Any:
+		# returns the parsed document, or None if upstream is down and nothing is cached.
+		# check `stale` afterwards to know whether the document could be revalidated
+		if self.is_fresh():
+			self.hits += 1
+			return self.model
+		self.misses += 1
+		if not self._fetching:
+			# every caller that misses while a fetch is running waits for that same fetch
+			self._fetching = asyncio.create_task(self._fetch())
+		if not wait and self.is_current():
+			# stale-while-revalidate: the data is still right for this rotation, don't make anyone wait
+			return self.model
+		return await asyncio.shield(self._fetching)
+
+	def invalidate(self) -> None:
+		self.expires = None
+
+	async def _fetch(self) -> Any:
+		try:
+			if self.readOnly and await self.load(onlyFresh=True):
+				self.stale = False
+				return self.model
+			self.fetches += 1
+			headers = dict()
+			if self.model is not None:
+				if self.etag:
+					headers["If-None-Match"] = self.etag
+				if self.lastModified:
+					headers["If-Modified-Since"] = self.lastModified
+			start = time.perf_counter()
+			try:
+				resp = await self.http.get(self.url, headers=headers, timeout=self.timeout)
+				if resp.status == 304 and self.model is not None:
+					self.notModified += 1
+					body = None
+				elif resp.ok:
+					body = await resp.text()
+					model, boundaryAt = self._parse(body)
+				else:
+					self._observe(start, "error")
+					return self._fail()
+			except (ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError):
+				self._observe(start, "error")
+				return self._fail()
+			self._observe(start, "not_modified" if body is None else "ok", body)
+			if body is not None:
+				self.model = model
+				self.boundaryAt = boundaryAt
+				self.generation += 1
+			self.etag = resp.headers.get("ETag", self.etag)
+			self.lastModified = resp.headers.get("Last-Modified", self.lastModified)
+			self.expires = self._compute_expiry(resp.headers)
+			self.fetchedAt = datetime.now(timezone.utc)
+			self.stale = False
+			if self.dbm and not self.readOnly:
+				await self.dbm.saveCachedResponse(self.url, self.etag, self.lastModified, self.fetchedAt.isoformat(), self.expires.isoformat(), body)
+			if body is not None and self.onChange:
+				await self.onChange(self.model)
+			return self.model
+		finally:
+			self._fetching = None
+
+	def _parse(self, body: str) -> tuple[Any, datetime | None]:
+		# the full document only lives until the model is made from it, the database keeps the body as-is
+		data = json.loads(body)
+		model = self.parse(data) if self.parse else data
+		return model, self.boundary(data) if self.boundary else None
+
+	def _observe(self, start: float, outcome: str, body: str | None = None) -> None:
+		if not self.metrics:
+			return
+		self.metrics.histogram("upstream_fetch_duration_seconds", "Time taken to fetch an upstream document.").observe(time.perf_counter() - start, url=self.url, outcome=outcome)
+		if body is not None:
+			self.metrics.histogram("upstream_response_bytes", "Size of fetched upstream documents.", SIZE_BUCKETS).observe(len(body), url=self.url)
+
+	def _fail(self) -> Any:
+		# keep serving whatever we had, flagged as stale, and try again a bit later
+		if self.model is not None:
+			self.stale = True
+			self.expires = datetime.now(timezone.utc) + RETRY_DELAY
+		return self.model
+
+	def _compute_expiry(self, headers) -> datetime:
+		# the rotation boundary wins when the document has one, otherwise follow the HTTP freshness headers
+		now = datetime.now(timezone.utc)
+		if self.boundaryAt:
+			if self.boundaryAt <= now:
+				# upstream hasn't rolled over to the new rotation yet
+				return now + RETRY_DELAY
+			return self.boundaryAt
+		httpExpiry = self._http_expiry(headers, now)
+		if httpExpiry and httpExpiry > now:
+			return httpExpiry
+		return now + self.fallbackTtl
+
+	def _http_expiry(self, headers, now: datetime) -> datetime | None:
+		cacheControl = headers.get("Cache-Control", "")
+		if "no-cache" in cacheControl or "no-store" in cacheControl:
+			return None
+		maxAge = re.search(r"max-age=(\d+)", cacheControl)
+		if maxAge:
+			age = 0
+			try:
+				age = int(headers.get("Age", 0))
+			except ValueError:
+				pass
+			return now + timedelta(seconds=max(int(maxAge.group(1)) - age, 0))
+		expires = headers.get("Expires")
+		if expires:
+			try:
+				return parsedate_to_datetime(expires)
+			except (TypeError, ValueError):
+				return None
+		return None
+
+class ReplyCache:
+	# rendered replies, thrown away as a whole once the version they were rendered from changes
+	replies: dict[Hashable, str]
+	version: Hashable
+	hits: int
+	misses: int
+
+	def __init__(self) -> None:
+		self.replies = dict()
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key: Hashable, version: Hashable, render: Callable[[], str]) -> str:
+		if version != self.version:
+			self.replies.clear()
+			self.version = version
+		reply = self.replies.get(key)
+		if reply is None:
+			self.misses += 1
+			reply = render()
+			self.replies[key] = reply
+		else:
+			self.hits += 1
+		return reply
@@ -1,8 +1,12 @@
 from __future__ import annotations
 from asyncpg import Record
 from attr import dataclass
-from mautrix.types import RoomID
+from mautrix.types import ContentURI, RoomID, UserID
 from mautrix.util.async_db import Database, Scheme
+from typing import AsyncIterator, Iterable
+
+# the event columns of the subscription table
+EVENT_COLUMNS = ("fest_soon", "fest_start", "bigrun_start", "event_start", "event_happen")
 
 @dataclass
 class Subscription:
@@ -57,69 +61,384 @@ class PastFest:
 			reported=reported
 		)
 
+@dataclass
+class CachedResponse:
+	url: str
+	etag: str | None
+	last_modified: str | None
+	fetched_at: str
+	expires: str
+	body: str
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> CachedResponse | None:
+		if not row:
+			return None
+		body = row["body"]
+		if not body:
+			return None
+		return cls(
+			url=row["url"],
+			etag=row["etag"],
+			last_modified=row["last_modified"],
+			fetched_at=row["fetched_at"],
+			expires=row["expires"],
+			body=body
+		)
+
+@dataclass
+class CachedMedia:
+	url: str
+	sha256: str
+	mxc: ContentURI
+	mimetype: str
+	size: int
+	width: int
+	height: int
+	thumbnail_mxc: ContentURI | None = None
+	thumbnail_mimetype: str | None = None
+	thumbnail_size: int | None = None
+	thumbnail_width: int | None = None
+	thumbnail_height: int | None = None
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> CachedMedia | None:
+		if not row:
+			return None
+		mxc = row["mxc"]
+		if not mxc:
+			return None
+		return cls(
+			url=row["url"],
+			sha256=row["sha256"],
+			mxc=mxc,
+			mimetype=row["mimetype"],
+			size=row["size"],
+			width=row["width"],
+			height=row["height"],
+			thumbnail_mxc=row["thumbnail_mxc"],
+			thumbnail_mimetype=row["thumbnail_mimetype"],
+			thumbnail_size=row["thumbnail_size"],
+			thumbnail_width=row["thumbnail_width"],
+			thumbnail_height=row["thumbnail_height"]
+		)
+
+@dataclass
+class UserPref:
+	user_id: UserID
+	timezone: str | None
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> UserPref | None:
+		if not row:
+			return None
+		user_id = row["user_id"]
+		if not user_id:
+			return None
+		return cls(
+			user_id=user_id,
+			timezone=row["timezone"]
+		)
+
+@dataclass
+class Rotation:
+	stage: str
+	mode: str
+	rule: str
+	start_time: str
+	end_time: str
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> Rotation | None:
+		if not row:
+			return None
+		stage = row["stage"]
+		if not stage:
+			return None
+		return cls(
+			stage=stage,
+			mode=row["mode"],
+			rule=row["rule"],
+			start_time=row["start_time"],
+			end_time=row["end_time"]
+		)
+
+@dataclass
+class StageStats:
+	mode: str
+	rule: str
+	count: int
+	first: str
+	last: str
+
+	@classmethod
+	def from_row(cls, row: Record | None) -> StageStats | None:
+		if not row:
+			return None
+		return cls(
+			mode=row["mode"],
+			rule=row["rule"],
+			count=row["count"],
+			first=row["first"],
+			last=row["last"]
+		)
+
 class DBManager:
 	db: Database
 	
 	def __init__(self, db: Database) -> None:
 		self.db = db
 
-	async def getSubscriptions(self) -> list[Subscription]:
-		q = """
+	async def iterSubscriptions(self, events: Iterable[str], batch: int = 500) -> AsyncIterator[Subscription]:
+		# streams the rooms subscribed to any of the given event columns, a batch at a time ordered by room_id
+		columns = [column for column in events if column in EVENT_COLUMNS]
+		if not columns:
+			return
+		q = f"""
 		SELECT room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon
 		FROM subscription
+		WHERE room_id > $1 AND ({" OR ".join(columns)})
+		ORDER BY room_id
+		LIMIT $2
 		"""
-		rows = await self.db.fetch(q)
-		return list(map(lambda row: Subscription.from_row(row), rows))
+		last = ""
+		while True:
+			rows = await self.db.fetch(q, last, batch)
+			for row in rows:
+				yield Subscription.from_row(row)
+			if len(rows) < batch:
+				return
+			last = rows[-1]["room_id"]
 
-
-	async def getSubscription(self, roomId: RoomID) -> Subscription:
+	async def subscribe(self, roomId: RoomID, festStart: bool = False, bigRunStart: bool = False, eventStart: bool = False, eventHappen: bool = False, festSoon: bool = False) -> None:
 		q = """
-		SELECT room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon
-		FROM subscription
-		WHERE room_id = $1
+		INSERT INTO subscription (room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon)
+		VALUES ($1, $2, $3, $4, $5, $6)
+		ON CONFLICT (room_id) DO UPDATE
+		SET fest_start = excluded.fest_start, bigrun_start = excluded.bigrun_start, event_start = excluded.event_start, event_happen = excluded.event_happen, fest_soon = excluded.fest_soon
 		"""
-		row = await self.db.fetchrow(q, roomId)
-		return Subscription.from_row(row)
-
-	async def subscribe(self, roomId: RoomID, festStart: bool = False, bigRunStart: bool = False, eventStart: bool = False, eventHappen: bool = False, festSoon: bool = False) -> None:
-		oldSub = await self.getSubscription(roomId)
-		if oldSub:
-			q = """
-			UPDATE subscription SET fest_start = $2, bigrun_start = $3, event_start = $4, event_happen = $5, fest_soon = $6 WHERE room_id = $1
-			"""
-		else:
-			q = """
-			INSERT INTO subscription (room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon)
-			VALUES ($1, $2, $3, $4, $5, $6)
-			"""
 		await self.db.execute(q, roomId, festStart, bigRunStart, eventStart, eventHappen, festSoon)
 
 	async def unsubscribe(self, roomId: RoomID) -> None:
 		q = "DELETE FROM subscription WHERE room_id = $1"
 		await self.db.execute(q, roomId)
 
-	async def updateRoomId(self, old: RoomID, new: RoomID) -> None:
-		await self.db.execute("UPDATE subscription SET room_id = $1 WHERE room_id = $2", new, old)
+	async def updateRoomId(self, old: RoomID, new: RoomID) -> Subscription | None:
+		# moves the subscription to the new room, merged with the one it may already have. returns what the new room ends up with
+		move = """
+		INSERT INTO subscription (room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon)
+		SELECT $2, fest_start, bigrun_start, event_start, event_happen, fest_soon
+		FROM subscription
+		WHERE room_id = $1
+		ON CONFLICT (room_id) DO UPDATE
+		SET fest_start = subscription.fest_start OR excluded.fest_start, bigrun_start = subscription.bigrun_start OR excluded.bigrun_start,
+			event_start = subscription.event_start OR excluded.event_start, event_happen = subscription.event_happen OR excluded.event_happen,
+			fest_soon = subscription.fest_soon OR excluded.fest_soon
+		"""
+		q = """
+		SELECT room_id, fest_start, bigrun_start, event_start, event_happen, fest_soon
+		FROM subscription
+		WHERE room_id = $1
+		"""
+		async with self.db.acquire() as conn, conn.transaction():
+			await conn.execute(move, old, new)
+			await conn.execute("DELETE FROM subscription WHERE room_id = $1", old)
+			return Subscription.from_row(await conn.fetchrow(q, new))
 
-	async def getPastFests(self) -> list[PastFest]:
+	async def getKnownFestIds(self, fest_ids: list[str]) -> set[str]:
+		if not fest_ids:
+			return set()
+		placeholders = ", ".join(f"${ii + 1}" for ii in range(len(fest_ids)))
+		q = f"""
+		SELECT fest_id
+		FROM past_fest
+		WHERE fest_id IN ({placeholders})
+		"""
+		rows = await self.db.fetch(q, *fest_ids)
+		return set(map(lambda row: row["fest_id"], rows))
+
+	async def getUnreportedFests(self) -> list[PastFest]:
 		q = """
 		SELECT fest_id, start_time, reported
 		FROM past_fest
+		WHERE reported = false
 		"""
 		rows = await self.db.fetch(q)
 		return list(map(lambda row: PastFest.from_row(row), rows))
 
+	async def getStartedFests(self, now: str) -> list[PastFest]:
+		# unreported fests whose start time has passed
+		q = """
+		SELECT fest_id, start_time, reported
+		FROM past_fest
+		WHERE reported = false AND start_time <= $1
+		"""
+		rows = await self.db.fetch(q, now)
+		return list(map(lambda row: PastFest.from_row(row), rows))
+
 	async def addFest(self, fest_id: str, start_time: str, reported: bool = False) -> None:
 		q = """
 		INSERT INTO past_fest (fest_id, start_time, reported)
 		VALUES ($1, $2, $3)
+		ON CONFLICT (fest_id) DO NOTHING
 		"""
 		await self.db.execute(q, fest_id, start_time, reported)
+
+	async def pruneFests(self, before: str) -> None:
+		q = """
+		DELETE FROM past_fest
+		WHERE reported = true AND start_time < $1
+		"""
+		await self.db.execute(q, before)
 	
-	async def markFestReported(self, fest_id: str) -> None:
+	async def markFestReported(self, fest_id: str, reported: bool = True) -> None:
 		q = """
 		UPDATE past_fest
 		SET reported = $2
 		WHERE fest_id = $1
 		"""
-		await self.db.execute(q, fest_id, True)
+		await self.db.execute(q, fest_id, reported)
+
+	async def forgetFest(self, fest_id: str) -> None:
+		await self.db.execute("DELETE FROM past_fest WHERE fest_id = $1", fest_id)
+
+	async def claimNotification(self, kind: str, entity: str, end_time: str) -> bool:
+		# true only for the first caller, so every entity is notified about exactly once
+		q = """
+		INSERT INTO notification (kind, entity, end_time)
+		VALUES ($1, $2, $3)
+		ON CONFLICT (kind, entity) DO NOTHING
+		RETURNING entity
+		"""
+		return await self.db.fetchval(q, kind, entity, end_time) is not None
+
+	async def releaseNotification(self, kind: str, entity: str) -> None:
+		# for when the notification couldn't be sent after all
+		q = """
+		DELETE FROM notification
+		WHERE kind = $1 AND entity = $2
+		"""
+		await self.db.execute(q, kind, entity)
+
+	async def pruneNotifications(self, before: str) -> None:
+		q = """
+		DELETE FROM notification
+		WHERE end_time < $1
+		"""
+		await self.db.execute(q, before)
+
+	async def getCachedResponse(self, url: str) -> CachedResponse | None:
+		q = """
+		SELECT url, etag, last_modified, fetched_at, expires, body
+		FROM upstream_cache
+		WHERE url = $1
+		"""
+		row = await self.db.fetchrow(q, url)
+		return CachedResponse.from_row(row)
+
+	async def saveCachedResponse(self, url: str, etag: str | None, lastModified: str | None, fetchedAt: str, expires: str, body: str | None = None) -> None:
+		if body is None:
+			# revalidated (304), only the metadata changed
+			q = """
+			UPDATE upstream_cache
+			SET etag = $2, last_modified = $3, fetched_at = $4, expires = $5
+			WHERE url = $1
+			"""
+			await self.db.execute(q, url, etag, lastModified, fetchedAt, expires)
+			return
+		q = """
+		INSERT INTO upstream_cache (url, etag, last_modified, fetched_at, expires, body)
+		VALUES ($1, $2, $3, $4, $5, $6)
+		ON CONFLICT (url) DO UPDATE
+		SET etag = excluded.etag, last_modified = excluded.last_modified, fetched_at = excluded.fetched_at, expires = excluded.expires, body = excluded.body
+		"""
+		await self.db.execute(q, url, etag, lastModified, fetchedAt, expires, body)
+
+	async def getMediaByUrl(self, url: str) -> CachedMedia | None:
+		q = """
+		SELECT url, sha256, mxc, mimetype, size, width, height, thumbnail_mxc, thumbnail_mimetype, thumbnail_size, thumbnail_width, thumbnail_height
+		FROM media
+		WHERE url = $1
+		"""
+		row = await self.db.fetchrow(q, url)
+		return CachedMedia.from_row(row)
+
+	async def getMediaByHash(self, sha256: str) -> CachedMedia | None:
+		q = """
+		SELECT url, sha256, mxc, mimetype, size, width, height, thumbnail_mxc, thumbnail_mimetype, thumbnail_size, thumbnail_width, thumbnail_height
+		FROM media
+		WHERE sha256 = $1
+		"""
+		row = await self.db.fetchrow(q, sha256)
+		return CachedMedia.from_row(row)
+
+	async def saveMedia(self, media: CachedMedia) -> None:
+		q = """
+		INSERT INTO media (url, sha256, mxc, mimetype, size, width, height, thumbnail_mxc, thumbnail_mimetype, thumbnail_size, thumbnail_width, thumbnail_height)
+		VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+		ON CONFLICT (url) DO UPDATE
+		SET sha256 = excluded.sha256, mxc = excluded.mxc, mimetype = excluded.mimetype, size = excluded.size, width = excluded.width, height = excluded.height,
+			thumbnail_mxc = excluded.thumbnail_mxc, thumbnail_mimetype = excluded.thumbnail_mimetype, thumbnail_size = excluded.thumbnail_size,
+			thumbnail_width = excluded.thumbnail_width, thumbnail_height = excluded.thumbnail_height
+		"""
+		await self.db.execute(q, media.url, media.sha256, media.mxc, media.mimetype, media.size, media.width, media.height,
+			media.thumbnail_mxc, media.thumbnail_mimetype, media.thumbnail_size, media.thumbnail_width, media.thumbnail_height)
+
+	async def getUserPrefs(self) -> list[UserPref]:
+		q = """
+		SELECT user_id, timezone
+		FROM user_pref
+		"""
+		rows = await self.db.fetch(q)
+		return list(map(lambda row: UserPref.from_row(row), rows))
+
+	async def setUserTimezone(self, userId: UserID, timezone: str | None) -> None:
+		q = """
+		INSERT INTO user_pref (user_id, timezone)
+		VALUES ($1, $2)
+		ON CONFLICT (user_id) DO UPDATE
+		SET timezone = excluded.timezone
+		"""
+		await self.db.execute(q, userId, timezone)
+
+	async def deleteUserPref(self, userId: UserID) -> None:
+		q = "DELETE FROM user_pref WHERE user_id = $1"
+		await self.db.execute(q, userId)
+
+	async def archiveRotations(self, rotations: list[Rotation]) -> None:
+		# the same rotation is seen on every fetch until it's over, so this is mostly no-ops
+		q = """
+		INSERT INTO rotation (stage, mode, start_time, end_time, rule)
+		VALUES ($1, $2, $3, $4, $5)
+		ON CONFLICT (stage, mode, start_time) DO UPDATE
+		SET end_time = excluded.end_time, rule = excluded.rule
+		WHERE rotation.end_time <> excluded.end_time OR rotation.rule <> excluded.rule
+		"""
+		await self.db.executemany(q, [(rot.stage, rot.mode, rot.start_time, rot.end_time, rot.rule) for rot in rotations])
+
+	async def getArchivedStages(self) -> list[str]:
+		q = "SELECT DISTINCT stage FROM rotation"
+		return [row["stage"] for row in await self.db.fetch(q)]
+
+	async def getUpcomingRotations(self, stage: str, now: str, limit: int = 50) -> list[Rotation]:
+		# the ongoing one included
+		q = """
+		SELECT stage, mode, rule, start_time, end_time
+		FROM rotation
+		WHERE stage = $1 AND end_time > $2
+		ORDER BY start_time
+		LIMIT $3
+		"""
+		rows = await self.db.fetch(q, stage, now, limit)
+		return list(map(lambda row: Rotation.from_row(row), rows))
+
+	async def getStageStats(self, stage: str, now: str) -> list[StageStats]:
+		q = """
+		SELECT mode, rule, COUNT(*) AS count, MIN(start_time) AS first, MAX(start_time) AS last
+		FROM rotation
+		WHERE stage = $1 AND start_time <= $2
+		GROUP BY mode, rule
+		ORDER BY count DESC, mode, rule
+		"""
+		rows = await self.db.fetch(q, stage, now)
+		return list(map(lambda row: StageStats.from_row(row), rows))
@@ -0,0 +1,82 @@
+from __future__ import annotations
+import asyncio
+from attr import dataclass
+from logging import Logger
+import time
+from typing import Awaitable, Callable
+from mautrix.errors import MatrixRequestError, MLimitExceeded
+from mautrix.types import RoomID
+
+Send = Callable[[], Awaitable]
+
+@dataclass
+class DeliveryStats:
+	rooms: int
+	messages: int
+	failed: int
+	retries: int
+	duration: float
+	# seconds from the start of the run until each room got its last message
+	latencies: list[float]
+
+	def percentile(self, p: float) -> float:
+		if not self.latencies:
+			return 0
+		ordered = sorted(self.latencies)
+		return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+	def summary(self) -> str:
+		return f"{self.messages} messages to {self.rooms} rooms in {self.duration:.2f}s ({self.failed} failed, {self.retries} retries), room latency p50 {self.percentile(0.5):.2f}s / p95 {self.percentile(0.95):.2f}s / max {self.percentile(1):.2f}s"
+
+class Delivery:
+	# sends the queued messages of many rooms at once, while every room still gets its messages in order
+	log: Logger
+	parallelism: int
+	retries: int
+	backoff: float
+
+	def __init__(self, log: Logger, parallelism: int = 10, retries: int = 5, backoff: float = 1) -> None:
+		self.log = log
+		self.parallelism = max(parallelism, 1)
+		self.retries = retries
+		self.backoff = backoff
+
+	async def run(self, jobs: dict[RoomID, list[Send]]) -> DeliveryStats:
+		stats = DeliveryStats(rooms=len(jobs), messages=0, failed=0, retries=0, duration=0, latencies=list())
+		semaphore = asyncio.Semaphore(self.parallelism)
+		start = time.monotonic()
+
+		async def deliver(roomId: RoomID, sends: list[Send]) -> None:
+			async with semaphore:
+				for send in sends:
+					if not await self._send(roomId, send, stats):
+						# the rest of this room would most likely fail the same way
+						stats.failed += 1
+						break
+					stats.messages += 1
+				stats.latencies.append(time.monotonic() - start)
+
+		await asyncio.gather(*(deliver(roomId, sends) for roomId, sends in jobs.items()))
+		stats.duration = time.monotonic() - start
+		return stats
+
+	async def _send(self, roomId: RoomID, send: Send, stats: DeliveryStats) -> bool:
+		delay = self.backoff
+		for attempt in range(self.retries + 1):
+			try:
+				await send()
+				return True
+			except MLimitExceeded:
+				if attempt == self.retries:
+					break
+				stats.retries += 1
+				await asyncio.sleep(delay)
+				delay *= 2
+			except MatrixRequestError as e:
+				self.log.warning(f"Failed to send rotation update to {roomId}: {e}")
+				return False
+			except Exception:
+				self.log.exception(f"Failed to send rotation update to {roomId}")
+				return False
+		self.log.warning(f"Gave up sending rotation update to {roomId} after {self.retries} retries")
+		return False
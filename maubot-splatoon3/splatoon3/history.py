@@ -0,0 +1,85 @@
+from __future__ import annotations
+from .db import DBManager, Rotation
+from .models import ISO_FORMAT, CoopNode, Schedules, VsNode
+
+# how modes are stored, and what they're called in replies
+MODE_NAMES = {
+	"turf": "Turf War",
+	"series": "Anarchy (Series)",
+	"open": "Anarchy (Open)",
+	"x": "X Battle",
+	"fest_open": "Splatfest (Open)",
+	"fest_pro": "Splatfest (Pro)",
+	"challenge": "Challenge",
+	"salmon": "Salmon Run",
+	"bigrun": "Big Run",
+	"eggstra": "Eggstra Work",
+}
+# the bankaraMode and festMode of a setting
+BANKARA_MODES = {"CHALLENGE": "series", "OPEN": "open"}
+FEST_MODES = {"REGULAR": "fest_open", "CHALLENGE": "fest_pro"}
+
+def _vs_rotations(nodes: list[VsNode], modes: tuple[str, ...], byMode: dict[str, str] | None = None) -> list[Rotation]:
+	# settings without a mode are told apart by the order upstream lists them in
+	rotations = list()
+	for node in nodes:
+		for ii, setting in enumerate(node.settings):
+			mode = (byMode or dict()).get(setting.mode) or modes[min(ii, len(modes) - 1)]
+			for stage in setting.stages:
+				rotations.append(Rotation(stage=stage.name, mode=mode, rule=setting.rule.name, start_time=node.start.strftime(ISO_FORMAT), end_time=node.end.strftime(ISO_FORMAT)))
+	return rotations
+
+def _coop_rotations(nodes: list[CoopNode], mode: str) -> list[Rotation]:
+	return [Rotation(stage=node.setting.stage.name, mode=mode, rule="", start_time=node.start.strftime(ISO_FORMAT), end_time=node.end.strftime(ISO_FORMAT)) for node in nodes]
+
+def rotations(data: Schedules) -> list[Rotation]:
+	# one row per stage of every rotation in the document
+	result = list()
+	result += _vs_rotations(data.regular, ("turf",))
+	result += _vs_rotations(data.bankara, ("series", "open"), BANKARA_MODES)
+	result += _vs_rotations(data.x, ("x",))
+	result += _vs_rotations(data.fest, ("fest_open", "fest_pro"), FEST_MODES)
+	for challenge in data.challenges:
+		for period in challenge.periods:
+			for stage in challenge.setting.stages:
+				result.append(Rotation(stage=stage.name, mode="challenge", rule=challenge.setting.rule.name, start_time=period.start.strftime(ISO_FORMAT), end_time=period.end.strftime(ISO_FORMAT)))
+	result += _coop_rotations(data.salmon, "salmon")
+	result += _coop_rotations(data.big_run, "bigrun")
+	result += _coop_rotations(data.eggstra, "eggstra")
+	return result
+
+class RotationHistory:
+	# every rotation the plugin has seen, kept in the database.
+	# only the stage names are kept in memory, to match what people type against
+	dbm: DBManager
+	stages: dict[str, str]
+
+	def __init__(self, dbm: DBManager) -> None:
+		self.dbm = dbm
+		self.stages = dict()
+
+	async def load(self) -> None:
+		self.stages = {stage.lower(): stage for stage in await self.dbm.getArchivedStages()}
+
+	async def archive(self, data: Schedules) -> None:
+		found = rotations(data)
+		await self.dbm.archiveRotations(found)
+		for rotation in found:
+			self.stages[rotation.stage.lower()] = rotation.stage
+
+	async def find_stage(self, query: str) -> list[str]:
+		# the stage with exactly that name, or every stage whose name contains it
+		stages = self._match(query)
+		if not stages:
+			# another instance may have archived stages we haven't seen
+			await self.load()
+			stages = self._match(query)
+		return stages
+
+	def _match(self, query: str) -> list[str]:
+		query = query.strip().lower()
+		if not query:
+			return list()
+		if query in self.stages:
+			return [self.stages[query]]
+		return sorted(stage for name, stage in self.stages.items() if query in name)
@@ -0,0 +1,43 @@
+from __future__ import annotations
+import time
+from mautrix.util.async_db import Database
+
+# how long a lease row stays valid without being renewed, and how often it's renewed
+LEASE_SECONDS = 60
+RENEW_SECONDS = 20
+LEASE_NAME = "rotation"
+
+class LeaderLease:
+	# makes sure only one of the instances sharing the plugin's tables checks rotations.
+	# the lease is a row in those tables, so instances with their own database or schema never compete
+	db: Database
+	holder: str
+	isLeader: bool
+
+	def __init__(self, db: Database, holder: str) -> None:
+		self.db = db
+		self.holder = holder
+		self.isLeader = False
+
+	async def acquire(self) -> bool:
+		# takes the lead if nobody has it or the holder stopped renewing, keeps it if we already do
+		now = int(time.time())
+		q = """
+		INSERT INTO leader_lease (name, holder, expires)
+		VALUES ($1, $2, $3)
+		ON CONFLICT (name) DO UPDATE
+		SET holder = excluded.holder, expires = excluded.expires
+		WHERE leader_lease.holder = excluded.holder OR leader_lease.expires < $4
+		RETURNING holder
+		"""
+		self.isLeader = await self.db.fetchval(q, LEASE_NAME, self.holder, now + LEASE_SECONDS, now) is not None
+		return self.isLeader
+
+	async def release(self) -> None:
+		if self.isLeader:
+			q = """
+			DELETE FROM leader_lease
+			WHERE name = $1 AND holder = $2
+			"""
+			await self.db.execute(q, LEASE_NAME, self.holder)
+		self.isLeader = False
@@ -0,0 +1,134 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import io
+import time
+from aiohttp import ClientError, ClientSession
+from mautrix.client import Client
+from PIL import Image
+from .db import CachedMedia, DBManager
+from .metrics import Metrics
+
+# formats every client can show, sent without touching the bytes
+PASSTHROUGH_FORMATS = {
+	"PNG": "image/png",
+	"JPEG": "image/jpeg",
+	"WEBP": "image/webp"
+}
+EXTENSIONS = {
+	"image/png": "png",
+	"image/jpeg": "jpg",
+	"image/webp": "webp"
+}
+
+def _transcode(data: bytes) -> bytes:
+	img = Image.open(io.BytesIO(data))
+	imgByteArr = io.BytesIO()
+	img.save(imgByteArr, format="PNG")
+	return imgByteArr.getvalue()
+
+def _thumbnail(data: bytes, size: int) -> tuple[bytes, int, int]:
+	img = Image.open(io.BytesIO(data))
+	img.draft("RGB", (size, size))
+	img = img.convert("RGB")
+	img.thumbnail((size, size))
+	imgByteArr = io.BytesIO()
+	img.save(imgByteArr, format="JPEG", quality=85)
+	return imgByteArr.getvalue(), img.size[0], img.size[1]
+
+class MediaCache:
+	# downloads, transcodes and uploads every image once, then hands out the stored mxc URI
+	http: ClientSession
+	client: Client
+	dbm: DBManager
+	maxPassthroughSize: int
+	thumbnailSize: int
+	metrics: Metrics | None
+	known: dict[str, CachedMedia]
+	_uploading: dict[str, asyncio.Task]
+
+	def __init__(self, http: ClientSession, client: Client, dbm: DBManager, maxPassthroughSize: int = 10 * 1024 * 1024, thumbnailSize: int = 0, metrics: Metrics | None = None) -> None:
+		self.http = http
+		self.client = client
+		self.dbm = dbm
+		self.maxPassthroughSize = maxPassthroughSize
+		self.thumbnailSize = thumbnailSize
+		self.metrics = metrics
+		self.known = dict()
+		self._uploading = dict()
+
+	async def get(self, url: str) -> CachedMedia | None:
+		media = self.known.get(url)
+		if media:
+			return media
+		task = self._uploading.get(url)
+		if not task:
+			# rooms asking for the same image at once share one upload
+			task = asyncio.create_task(self._get(url))
+			self._uploading[url] = task
+			task.add_done_callback(lambda _: self._uploading.pop(url, None))
+		media = await asyncio.shield(task)
+		if media:
+			self.known[url] = media
+		return media
+
+	async def _get(self, url: str) -> CachedMedia | None:
+		# None when the image can't be downloaded or isn't one, it'll be tried again next time it's asked for
+		media = await self.dbm.getMediaByUrl(url)
+		if media:
+			return media
+		try:
+			resp = await self.http.get(url)
+			if not resp.ok:
+				return None
+			data = await resp.read()
+		except (ClientError, asyncio.TimeoutError):
+			return None
+		sha256 = hashlib.sha256(data).hexdigest()
+		media = await self.dbm.getMediaByHash(sha256)
+		if media:
+			# same picture under another url, no need to upload it again
+			media.url = url
+			await self.dbm.saveMedia(media)
+			return media
+		loop = asyncio.get_running_loop()
+		try:
+			# opening only reads the header, the pixels aren't decoded until something needs them
+			img = Image.open(io.BytesIO(data))
+			width, height = img.size
+			mimetype = PASSTHROUGH_FORMATS.get(img.format)
+			if not mimetype or len(data) > self.maxPassthroughSize:
+				data = await loop.run_in_executor(None, _transcode, data)
+				mimetype = "image/png"
+		except (OSError, ValueError, Image.DecompressionBombError):
+			# UnidentifiedImageError and truncated images are OSErrors
+			return None
+		mxc = await self._upload(data, mimetype, "rot." + EXTENSIONS[mimetype])
+		media = CachedMedia(
+			url=url,
+			sha256=sha256,
+			mxc=mxc,
+			mimetype=mimetype,
+			size=len(data),
+			width=width,
+			height=height
+		)
+		if self.thumbnailSize > 0 and max(width, height) > self.thumbnailSize:
+			thumbnail, media.thumbnail_width, media.thumbnail_height = await loop.run_in_executor(None, _thumbnail, data, self.thumbnailSize)
+			media.thumbnail_mxc = await self._upload(thumbnail, "image/jpeg", "thumbnail.jpg")
+			media.thumbnail_mimetype = "image/jpeg"
+			media.thumbnail_size = len(thumbnail)
+		await self.dbm.saveMedia(media)
+		return media
+
+	async def _upload(self, data: bytes, mimetype: str, filename: str) -> str:
+		start = time.perf_counter()
+		mxc = await self.client.upload_media(data, mimetype, filename)
+		if self.metrics:
+			self.metrics.histogram("media_upload_duration_seconds", "Time taken to upload an image to the homeserver.").observe(time.perf_counter() - start, mimetype=mimetype)
+		return mxc
+
+	@staticmethod
+	def filename(media: CachedMedia) -> str:
+		return "rot." + EXTENSIONS.get(media.mimetype, "png")
+
@@ -35,4 +35,117 @@ async def upgrade_v3(conn: Connection, scheme: Scheme) -> None:
 
 			PRIMARY KEY (id)
 		)"""
-	)
\ No newline at end of file
+	)
+
+@upgrade_table.register(description="Last good responses of splatoon3.ink")
+async def upgrade_v4(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS upstream_cache (
+			url TEXT NOT NULL,
+			etag TEXT,
+			last_modified TEXT,
+			fetched_at TEXT NOT NULL,
+			expires TEXT NOT NULL,
+			body TEXT NOT NULL,
+
+			PRIMARY KEY (url)
+		)"""
+	)
+
+@upgrade_table.register(description="Uploaded media cache")
+async def upgrade_v5(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS media (
+			url TEXT NOT NULL,
+			sha256 TEXT NOT NULL,
+			mxc TEXT NOT NULL,
+			mimetype TEXT NOT NULL,
+			size INTEGER NOT NULL,
+			width INTEGER NOT NULL,
+			height INTEGER NOT NULL,
+
+			PRIMARY KEY (url)
+		)"""
+	)
+	await conn.execute("CREATE INDEX IF NOT EXISTS media_sha256_idx ON media (sha256)")
+
+@upgrade_table.register(description="Thumbnails of uploaded media")
+async def upgrade_v6(conn: Connection) -> None:
+	await conn.execute("ALTER TABLE media ADD COLUMN thumbnail_mxc TEXT")
+	await conn.execute("ALTER TABLE media ADD COLUMN thumbnail_mimetype TEXT")
+	await conn.execute("ALTER TABLE media ADD COLUMN thumbnail_size INTEGER")
+	await conn.execute("ALTER TABLE media ADD COLUMN thumbnail_width INTEGER")
+	await conn.execute("ALTER TABLE media ADD COLUMN thumbnail_height INTEGER")
+
+@upgrade_table.register(description="Unique room_id and per-event indexes for subscription")
+async def upgrade_v7(conn: Connection) -> None:
+	# keep only the latest row of rooms that were subscribed more than once
+	await conn.execute("DELETE FROM subscription WHERE id NOT IN (SELECT MAX(id) FROM subscription GROUP BY room_id)")
+	await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS subscription_room_id_idx ON subscription (room_id)")
+	for column in ("fest_soon", "fest_start", "bigrun_start", "event_start", "event_happen"):
+		await conn.execute(f"CREATE INDEX IF NOT EXISTS subscription_{column}_idx ON subscription (room_id) WHERE {column}")
+
+@upgrade_table.register(description="Indexes for past_fest")
+async def upgrade_v8(conn: Connection) -> None:
+	await conn.execute("DELETE FROM past_fest WHERE id NOT IN (SELECT MAX(id) FROM past_fest GROUP BY fest_id)")
+	await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS past_fest_fest_id_idx ON past_fest (fest_id)")
+	await conn.execute("CREATE INDEX IF NOT EXISTS past_fest_reported_start_time_idx ON past_fest (reported, start_time)")
+
+@upgrade_table.register(description="Notifications already sent")
+async def upgrade_v9(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS notification (
+			kind TEXT NOT NULL,
+			entity TEXT NOT NULL,
+			end_time TEXT NOT NULL,
+
+			PRIMARY KEY (kind, entity)
+		)"""
+	)
+	await conn.execute("CREATE INDEX IF NOT EXISTS notification_end_time_idx ON notification (end_time)")
+
+@upgrade_table.register(description="Rotation checker lease")
+async def upgrade_v10(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS leader_lease (
+			name TEXT NOT NULL,
+			holder TEXT NOT NULL,
+			expires BIGINT NOT NULL,
+
+			PRIMARY KEY (name)
+		)"""
+	)
+
+@upgrade_table.register(description="Per-user preferences")
+async def upgrade_v11(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS user_pref (
+			user_id TEXT NOT NULL,
+			timezone TEXT,
+
+			PRIMARY KEY (user_id)
+		)"""
+	)
+
+@upgrade_table.register(description="Rotation history")
+async def upgrade_v12(conn: Connection) -> None:
+	await conn.execute(
+		"""CREATE TABLE IF NOT EXISTS rotation (
+			stage TEXT NOT NULL,
+			mode TEXT NOT NULL,
+			start_time TEXT NOT NULL,
+			end_time TEXT NOT NULL,
+			rule TEXT NOT NULL,
+
+			PRIMARY KEY (stage, mode, start_time)
+		)"""
+	)
+	# every lookup starts from a stage, the counts per rule and mode are read from the index alone
+	await conn.execute("CREATE INDEX IF NOT EXISTS rotation_stage_rule_mode_idx ON rotation (stage, rule, mode, start_time)")
+	# upcoming rotations are everything that hasn't ended yet, a short range at the end of a stage's history
+	await conn.execute("CREATE INDEX IF NOT EXISTS rotation_stage_end_time_idx ON rotation (stage, end_time)")
+
+@upgrade_table.register(description="Drop subscriptions without events")
+async def upgrade_v13(conn: Connection) -> None:
+	# subscribing to nothing used to keep an empty row around instead of unsubscribing
+	await conn.execute("DELETE FROM subscription WHERE NOT (fest_start OR bigrun_start OR event_start OR event_happen OR fest_soon)")
@@ -0,0 +1,214 @@
+from __future__ import annotations
+from datetime import datetime
+from attr import dataclass
+
+# parsed once per fetch, so rendering is nothing but attribute reads
+
+# the timestamp format used by splatoon3.ink
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def _time(iso: str) -> datetime:
+	return datetime.fromisoformat(iso)
+
+def _nodes(obj: dict | None) -> list[dict]:
+	if not obj:
+		return list()
+	return obj.get("nodes") or list()
+
+@dataclass(slots=True)
+class Stage:
+	id: str | None
+	name: str
+	image: str | None
+
+	@classmethod
+	def from_json(cls, obj: dict) -> Stage:
+		image = obj.get("image") or obj.get("thumbnailImage")
+		return cls(
+			id=obj.get("id"),
+			name=obj["name"],
+			image=image["url"] if image else None
+		)
+
+@dataclass(slots=True)
+class Rule:
+	name: str
+	rule: str | None
+
+	@classmethod
+	def from_json(cls, obj: dict) -> Rule:
+		return cls(
+			name=obj["name"],
+			rule=obj.get("rule")
+		)
+
+@dataclass(slots=True)
+class MatchSetting:
+	rule: Rule
+	stages: list[Stage]
+	mode: str | None
+
+	@classmethod
+	def from_json(cls, obj: dict) -> MatchSetting:
+		return cls(
+			rule=Rule.from_json(obj["vsRule"]),
+			stages=[Stage.from_json(stage) for stage in obj["vsStages"]],
+			mode=obj.get("bankaraMode") or obj.get("festMode")
+		)
+
+@dataclass(slots=True)
+class VsNode:
+	start: datetime
+	end: datetime
+	# empty when the rotation is replaced by a Splatfest
+	settings: list[MatchSetting]
+
+	@classmethod
+	def from_json(cls, obj: dict, key: str) -> VsNode:
+		settings = obj.get(key) or list()
+		if type(settings) is dict:
+			settings = [settings]
+		return cls(
+			start=_time(obj["startTime"]),
+			end=_time(obj["endTime"]),
+			settings=[MatchSetting.from_json(setting) for setting in settings]
+		)
+
+@dataclass(slots=True)
+class TimePeriod:
+	start: datetime
+	end: datetime
+
+	@classmethod
+	def from_json(cls, obj: dict) -> TimePeriod:
+		return cls(
+			start=_time(obj["startTime"]),
+			end=_time(obj["endTime"])
+		)
+
+@dataclass(slots=True)
+class LeagueEvent:
+	id: str | None
+	name: str
+	desc: str
+	regulation: str
+
+	@classmethod
+	def from_json(cls, obj: dict) -> LeagueEvent:
+		return cls(
+			id=obj.get("leagueMatchEventId") or obj.get("id"),
+			name=obj["name"],
+			desc=obj.get("desc") or "",
+			regulation=obj.get("regulation") or ""
+		)
+
+@dataclass(slots=True)
+class Challenge:
+	event: LeagueEvent
+	setting: MatchSetting
+	periods: list[TimePeriod]
+
+	@classmethod
+	def from_json(cls, obj: dict) -> Challenge:
+		setting = obj["leagueMatchSetting"]
+		return cls(
+			event=LeagueEvent.from_json(setting["leagueMatchEvent"]),
+			setting=MatchSetting.from_json(setting),
+			periods=[TimePeriod.from_json(period) for period in obj.get("timePeriods") or list()]
+		)
+
+@dataclass(slots=True)
+class CoopSetting:
+	stage: Stage
+	boss: str | None
+	weapons: list[str]
+
+	@classmethod
+	def from_json(cls, obj: dict) -> CoopSetting:
+		boss = obj.get("boss")
+		return cls(
+			stage=Stage.from_json(obj["coopStage"]),
+			boss=boss["name"] if boss else None,
+			weapons=[weapon["name"] for weapon in obj.get("weapons") or list()]
+		)
+
+@dataclass(slots=True)
+class CoopNode:
+	start: datetime
+	end: datetime
+	setting: CoopSetting
+
+	@classmethod
+	def from_json(cls, obj: dict) -> CoopNode:
+		return cls(
+			start=_time(obj["startTime"]),
+			end=_time(obj["endTime"]),
+			setting=CoopSetting.from_json(obj["setting"])
+		)
+
+@dataclass(slots=True)
+class Schedules:
+	regular: list[VsNode]
+	bankara: list[VsNode]
+	x: list[VsNode]
+	fest: list[VsNode]
+	challenges: list[Challenge]
+	salmon: list[CoopNode]
+	big_run: list[CoopNode]
+	eggstra: list[CoopNode]
+	current_fest: dict | None
+
+	@classmethod
+	def from_json(cls, obj: dict) -> Schedules:
+		data = obj["data"]
+		coop = data.get("coopGroupingSchedule") or dict()
+		return cls(
+			regular=[VsNode.from_json(node, "regularMatchSetting") for node in _nodes(data.get("regularSchedules"))],
+			bankara=[VsNode.from_json(node, "bankaraMatchSettings") for node in _nodes(data.get("bankaraSchedules"))],
+			x=[VsNode.from_json(node, "xMatchSetting") for node in _nodes(data.get("xSchedules"))],
+			fest=[VsNode.from_json(node, "festMatchSettings") for node in _nodes(data.get("festSchedules"))],
+			challenges=[Challenge.from_json(node) for node in _nodes(data.get("eventSchedules"))],
+			salmon=[CoopNode.from_json(node) for node in _nodes(coop.get("regularSchedules"))],
+			big_run=[CoopNode.from_json(node) for node in _nodes(coop.get("bigRunSchedules"))],
+			eggstra=[CoopNode.from_json(node) for node in _nodes(coop.get("teamContestSchedules"))],
+			current_fest=data.get("currentFest")
+		)
+
+@dataclass(slots=True)
+class Fest:
+	id: str
+	region: str
+	state: str
+	title: str
+	start: datetime
+	end: datetime
+	teams: list[str]
+	image: str | None
+
+	@classmethod
+	def from_json(cls, obj: dict, region: str) -> Fest:
+		image = obj.get("image")
+		return cls(
+			id=obj["__splatoon3ink_id"],
+			region=region,
+			state=obj["state"],
+			title=obj["title"],
+			start=_time(obj["startTime"]),
+			end=_time(obj["endTime"]),
+			teams=[team["teamName"] for team in obj.get("teams") or list()],
+			image=image["url"] if image else None
+		)
+
+@dataclass(slots=True)
+class Festivals:
+	# the latest fest of every region
+	latest: list[Fest]
+
+	@classmethod
+	def from_json(cls, obj: dict) -> Festivals:
+		latest = list()
+		for region, regionData in obj.items():
+			nodes = _nodes(regionData["data"]["festRecords"])
+			if nodes:
+				latest.append(Fest.from_json(nodes[0], region))
+		return cls(latest=latest)
@@ -0,0 +1,89 @@
+from __future__ import annotations
+from datetime import timedelta, timezone, tzinfo
+from functools import lru_cache
+import re
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+from mautrix.types import UserID
+from .db import DBManager
+
+# timezones are passed around by name: an IANA zone like "Europe/London" or a fixed offset like "+05:30"
+UTC = "+00:00"
+# what people type for a fixed offset: "+8", "-3:30", "UTC+0530", "GMT-4"
+OFFSET_PATTERN = re.compile(r"(?:UTC|GMT)?\s*([+-]?)(\d{1,2})(?::?(\d{2}))?", re.IGNORECASE)
+# the last number in a displayname that looks like an offset, e.g. "Someone (+8)"
+DISPLAYNAME_PATTERN = re.compile(r"((\+?|-)\d{1,2})(:\d{2})?")
+
+def _offset_name(sign: str, hours: str, minutes: str | None) -> str | None:
+	hours = int(hours)
+	minutes = int(minutes or 0)
+	# real offsets stay within 14 hours of UTC, in steps of 15 minutes at most
+	if hours > 14 or minutes >= 60 or minutes % 15 != 0:
+		return None
+	return ("-" if sign == "-" else "+") + f"{hours:02}:{minutes:02}"
+
+def normalize_timezone(value: str) -> str | None:
+	# the name a timezone is stored and cached under, None if it isn't one
+	value = value.strip()
+	if value.upper() in ("UTC", "GMT", "Z"):
+		return UTC
+	match = OFFSET_PATTERN.fullmatch(value)
+	if match:
+		return _offset_name(*match.groups())
+	try:
+		return ZoneInfo(value).key
+	except (ZoneInfoNotFoundError, ValueError):
+		# "asia/tokyo" is still Asia/Tokyo
+		return _zone_names().get(value.lower())
+
+@lru_cache(maxsize=1)
+def _zone_names() -> dict[str, str]:
+	return {name.lower(): name for name in available_timezones()}
+
+@lru_cache(maxsize=None)
+def get_tzinfo(name: str) -> tzinfo:
+	if name[0] not in "+-":
+		return ZoneInfo(name)
+	hours, minutes = name[1:].split(":")
+	offset = timedelta(hours=int(hours), minutes=int(minutes))
+	return timezone(-offset if name[0] == "-" else offset)
+
+def timezone_label(name: str) -> str:
+	return "UTC" + name if name[0] in "+-" else name
+
+@lru_cache(maxsize=4096)
+def displayname_timezone(name: str) -> str:
+	# for people who didn't set a timezone, cached because displaynames rarely change
+	matches = DISPLAYNAME_PATTERN.findall(name)
+	if not matches:
+		return UTC
+	hours, sign, minutes = matches[-1]
+	hours = hours.lstrip("+-")
+	return _offset_name(sign, hours, minutes[1:]) or _offset_name(sign, hours, None) or UTC
+
+class UserPrefs:
+	# every user's preferences kept in memory, changes are written through to the database
+	dbm: DBManager
+	timezones: dict[UserID, str]
+
+	def __init__(self, dbm: DBManager) -> None:
+		self.dbm = dbm
+		self.timezones = dict()
+
+	async def load(self) -> None:
+		self.timezones.clear()
+		for pref in await self.dbm.getUserPrefs():
+			# a zone can disappear from tzdata, forget it instead of failing later
+			timezone = pref.timezone and normalize_timezone(pref.timezone)
+			if timezone:
+				self.timezones[pref.user_id] = timezone
+
+	def timezone(self, userId: UserID) -> str | None:
+		return self.timezones.get(userId)
+
+	async def setTimezone(self, userId: UserID, timezone: str | None) -> None:
+		if timezone:
+			await self.dbm.setUserTimezone(userId, timezone)
+			self.timezones[userId] = timezone
+		else:
+			await self.dbm.deleteUserPref(userId)
+			self.timezones.pop(userId, None)
@@ -0,0 +1,62 @@
+from __future__ import annotations
+import asyncio
+from datetime import datetime, timedelta, timezone
+import heapq
+
+# what a wake-up is for
+CHALLENGE = "challenge"
+BIG_RUN = "bigrun"
+FEST = "fest"
+SCHEDULES = "schedules"
+ALL = frozenset((CHALLENGE, BIG_RUN, FEST, SCHEDULES))
+# the kinds that may have something to notify about
+NOTIFY = frozenset((CHALLENGE, BIG_RUN, FEST))
+
+# upstream times are exact, give them a second so "now" is definitely past them
+MARGIN = timedelta(seconds=1)
+
+class RotationScheduler:
+	# a min-heap of the moments something is due, so the checker sleeps exactly until the next one
+	heap: list[tuple[datetime, str]]
+	queued: set[tuple[datetime, str]]
+	changed: asyncio.Event
+
+	def __init__(self) -> None:
+		self.heap = list()
+		self.queued = set()
+		self.changed = asyncio.Event()
+
+	def schedule(self, when: datetime, kind: str) -> None:
+		entry = (when + MARGIN, kind)
+		if entry in self.queued:
+			return
+		self.queued.add(entry)
+		heapq.heappush(self.heap, entry)
+		if self.heap[0] is entry:
+			# sooner than what the loop is sleeping for
+			self.changed.set()
+
+	def next_time(self) -> datetime | None:
+		return self.heap[0][0] if self.heap else None
+
+	def pop_due(self) -> set[str]:
+		now = datetime.now(timezone.utc)
+		due = set()
+		while self.heap and self.heap[0][0] <= now:
+			entry = heapq.heappop(self.heap)
+			self.queued.discard(entry)
+			due.add(entry[1])
+		return due
+
+	async def wait(self) -> None:
+		# returns once the earliest entry is due; recomputed from the wall clock every time so it doesn't drift
+		while True:
+			self.changed.clear()
+			nextTime = self.next_time()
+			timeout = None if not nextTime else (nextTime - datetime.now(timezone.utc)).total_seconds()
+			if timeout is not None and timeout <= 0:
+				return
+			try:
+				await asyncio.wait_for(self.changed.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
@@ -0,0 +1,69 @@
+from __future__ import annotations
+from typing import Iterable
+from mautrix.types import RoomID
+from .db import EVENT_COLUMNS, DBManager, Subscription
+
+class SubscriptionRegistry:
+	# every subscription kept in memory, by room and by event.
+	# changes are written through to the database, so reads never need to touch it
+	dbm: DBManager
+	byRoom: dict[RoomID, Subscription]
+	byEvent: dict[str, set[RoomID]]
+
+	def __init__(self, dbm: DBManager) -> None:
+		self.dbm = dbm
+		self.byRoom = dict()
+		self.byEvent = {column: set() for column in EVENT_COLUMNS}
+
+	async def load(self) -> None:
+		self.byRoom.clear()
+		for rooms in self.byEvent.values():
+			rooms.clear()
+		async for sub in self.dbm.iterSubscriptions(EVENT_COLUMNS):
+			self._add(sub)
+
+	def get(self, roomId: RoomID) -> Subscription | None:
+		return self.byRoom.get(roomId)
+
+	def rooms(self, events: Iterable[str]) -> list[Subscription]:
+		# the subscriptions of every room that wants any of the given events
+		roomIds = set()
+		for column in events:
+			roomIds.update(self.byEvent.get(column, ()))
+		return [self.byRoom[roomId] for roomId in sorted(roomIds)]
+
+	async def subscribe(self, roomId: RoomID, festStart: bool = False, bigRunStart: bool = False, eventStart: bool = False, eventHappen: bool = False, festSoon: bool = False) -> None:
+		await self.dbm.subscribe(roomId, festStart, bigRunStart, eventStart, eventHappen, festSoon)
+		self._remove(roomId)
+		self._add(Subscription(
+			room_id=roomId,
+			fest_soon=festSoon,
+			fest_start=festStart,
+			bigrun_start=bigRunStart,
+			event_start=eventStart,
+			event_happen=eventHappen
+		))
+
+	async def unsubscribe(self, roomId: RoomID) -> None:
+		await self.dbm.unsubscribe(roomId)
+		self._remove(roomId)
+
+	async def updateRoomId(self, old: RoomID, new: RoomID) -> None:
+		# the new room may have been subscribed already, take whatever the database merged them into
+		sub = await self.dbm.updateRoomId(old, new)
+		self._remove(old)
+		self._remove(new)
+		if sub:
+			self._add(sub)
+
+	def _add(self, sub: Subscription) -> None:
+		self.byRoom[sub.room_id] = sub
+		for column in EVENT_COLUMNS:
+			if getattr(sub, column):
+				self.byEvent[column].add(sub.room_id)
+
+	def _remove(self, roomId: RoomID) -> Subscription | None:
+		sub = self.byRoom.pop(roomId, None)
+		for rooms in self.byEvent.values():
+			rooms.discard(roomId)
+		return sub
@@ -1,11 +1,56 @@
+from aiohttp.web import Request, Response
 from maubot import MessageEvent, Plugin
-from maubot.handlers import command
-from typing import Tuple
+from maubot.handlers import event, web
+from mautrix.types import EventType, MessageType, RoomID
+import time
+from .metrics import CONTENT_TYPE, Metrics, timed_command
+
+# a room can get this many reactions in a row, then one more every REFILL_SECONDS
+BURST = 3
+REFILL_SECONDS = 10
 
 class SummatiaPlugin(Plugin):
-	@command.passive("summatia",case_insensitive=True)
-	async def summatia_mentioned(self, evt: MessageEvent, matches: Tuple[str]) -> None:
-		if any(map(lambda x: "SUMMATIA" in x, matches)):
-			await evt.react("‼️")
-		else:
-			await evt.react("❗")
\ No newline at end of file
+	metrics: Metrics
+	# reactions each room has left, and when that was last worked out
+	buckets: dict[RoomID, tuple[float, float]]
+
+	async def start(self) -> None:
+		await super().start()
+		self.metrics = Metrics("summatia")
+		self.buckets = dict()
+
+	@event.on(EventType.ROOM_MESSAGE)
+	@timed_command("summatia")
+	async def summatia_mentioned(self, evt: MessageEvent) -> None:
+		if evt.sender == self.client.mxid or evt.content.msgtype != MessageType.TEXT:
+			return
+		self.metrics.counter("messages_scanned_total", "Messages checked for a mention.").inc()
+		reaction = self._reaction(evt.content.body)
+		if not reaction:
+			return
+		if not self._take_token(evt.room_id):
+			# a flood of mentions only gets the first few reactions
+			self.metrics.counter("mentions_coalesced_total", "Mentions not reacted to because the room was rate limited.").inc()
+			return
+		self.metrics.counter("reactions_total", "Reactions sent, by reaction.").inc(reaction=reaction)
+		await evt.react(reaction)
+
+	@web.get("/metrics")
+	async def metrics_endpoint(self, req: Request) -> Response:
+		return Response(text=self.metrics.render(), headers={"Content-Type": CONTENT_TYPE})
+
+	def _reaction(self, body: str) -> str | None:
+		# plain substring checks, way cheaper than a case-insensitive regex on every message
+		if "summatia" not in body.lower():
+			return None
+		return "‼️" if "SUMMATIA" in body else "❗"
+
+	def _take_token(self, roomId: RoomID) -> bool:
+		now = time.monotonic()
+		tokens, last = self.buckets.get(roomId, (BURST, now))
+		tokens = min(BURST, tokens + (now - last) / REFILL_SECONDS)
+		if tokens < 1:
+			self.buckets[roomId] = (tokens, now)
+			return False
+		self.buckets[roomId] = (tokens - 1, now)
+		return True
@@ -0,0 +1,193 @@
+# Minimal Prometheus-style metrics, shared by every plugin.
+# Each plugin package has a symlink to this file, so it is packaged with the plugin like any other module.
+from __future__ import annotations
+import functools
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+Labels = tuple[tuple[str, str], ...]
+# something that yields (labels, value) pairs whenever the metrics are rendered
+Collector = Callable[[], Iterable[tuple[dict[str, str], float]]]
+
+# seconds, from a cached reply up to a slow upstream
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes, from a small swatch up to a large fest image
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _label(value: Any) -> str:
+	if isinstance(value, bool):
+		return "true" if value else "false"
+	return str(value)
+
+def _labels(labels: dict[str, Any]) -> Labels:
+	return tuple(sorted((key, _label(value)) for key, value in labels.items()))
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+	pairs = labels + (extra,) if extra else labels
+	if not pairs:
+		return ""
+	return "{" + ",".join(f"{key}=\"{_escape(value)}\"" for key, value in pairs) + "}"
+
+def _number(value: float) -> str:
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+	name: str
+	help: str
+	values: dict[Labels, float]
+	collect: Collector | None
+
+	def __init__(self, name: str, help: str, collect: Collector | None = None) -> None:
+		self.name = name
+		self.help = help
+		self.values = dict()
+		self.collect = collect
+
+	def inc(self, amount: float = 1, **labels: Any) -> None:
+		key = _labels(labels)
+		self.values[key] = self.values.get(key, 0) + amount
+
+	def _samples(self) -> Iterable[tuple[Labels, float]]:
+		yield from self.values.items()
+		if self.collect:
+			for labels, value in self.collect():
+				yield _labels(labels), value
+
+	def render(self, kind: str = "counter") -> list[str]:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+		for labels, value in self._samples():
+			lines.append(f"{self.name}{_format(labels)} {_number(value)}")
+		return lines
+
+class Gauge(Counter):
+	def set(self, value: float, **labels: Any) -> None:
+		self.values[_labels(labels)] = value
+
+	def render(self, kind: str = "gauge") -> list[str]:
+		return super().render(kind)
+
+class Histogram:
+	name: str
+	help: str
+	buckets: tuple[float, ...]
+	# per label set: count of every bucket (not cumulative), sum and count
+	values: dict[Labels, tuple[list[int], list[float]]]
+
+	def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+		self.name = name
+		self.help = help
+		self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+		self.values = dict()
+
+	def observe(self, value: float, **labels: Any) -> None:
+		key = _labels(labels)
+		entry = self.values.get(key)
+		if not entry:
+			entry = ([0] * len(self.buckets), [0.0, 0])
+			self.values[key] = entry
+		counts, total = entry
+		for ii, bound in enumerate(self.buckets):
+			if value <= bound:
+				counts[ii] += 1
+				break
+		total[0] += value
+		total[1] += 1
+
+	def time(self, **labels: Any) -> "_Timer":
+		return _Timer(self, labels)
+
+	def render(self) -> list[str]:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		for labels, (counts, total) in self.values.items():
+			cumulative = 0
+			for bound, count in zip(self.buckets, counts):
+				cumulative += count
+				lines.append(f"{self.name}_bucket{_format(labels, ('le', _number(bound)))} {cumulative}")
+			lines.append(f"{self.name}_sum{_format(labels)} {_number(total[0])}")
+			lines.append(f"{self.name}_count{_format(labels)} {total[1]}")
+		return lines
+
+class _Timer:
+	# `with histogram.time(...)` observes how long the block took, even if it raised
+	def __init__(self, histogram: Histogram, labels: dict[str, Any]) -> None:
+		self.histogram = histogram
+		self.labels = labels
+		self.start = 0.0
+
+	def __enter__(self) -> "_Timer":
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc) -> None:
+		self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Metrics:
+	# the metrics of one plugin instance, all prefixed with the plugin's namespace
+	namespace: str
+	metrics: dict[str, Counter | Histogram]
+
+	def __init__(self, namespace: str) -> None:
+		self.namespace = namespace
+		self.metrics = dict()
+
+	def counter(self, name: str, help: str, collect: Collector | None = None) -> Counter:
+		return self._get(name, lambda fullName: Counter(fullName, help, collect))
+
+	def gauge(self, name: str, help: str, collect: Collector | None = None) -> Gauge:
+		return self._get(name, lambda fullName: Gauge(fullName, help, collect))
+
+	def histogram(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+		return self._get(name, lambda fullName: Histogram(fullName, help, buckets))
+
+	def render(self) -> str:
+		lines = list()
+		for metric in self.metrics.values():
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+	def _get(self, name: str, create: Callable[[str], Any]) -> Any:
+		# asking for a metric again returns the same one
+		metric = self.metrics.get(name)
+		if not metric:
+			metric = create(f"{self.namespace}_{name}")
+			self.metrics[name] = metric
+		return metric
+
+def timed(name: str, help: str, **labels: Any) -> Callable[[Callable[..., Awaitable]], Callable[..., Awaitable]]:
+	# times a coroutine method into the `self.metrics` histogram of the given name
+	def decorator(func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+		@functools.wraps(func)
+		async def wrapper(self, *args, **kwargs):
+			with self.metrics.histogram(name, help).time(**labels):
+				return await func(self, *args, **kwargs)
+		return wrapper
+	return decorator
+
+def timed_command(command: str) -> Callable[[Callable[..., Awaitable]], Callable[..., Awaitable]]:
+	return timed("command_duration_seconds", "Time taken to handle a command.", command=command)
+
+class TimedDatabase:
+	# stands in for a mautrix Database and times every query made through it
+	QUERY_METHODS = ("execute", "executemany", "fetch", "fetchrow", "fetchval")
+
+	def __init__(self, db: Any, metrics: Metrics) -> None:
+		self._db = db
+		self._histogram = metrics.histogram("db_query_duration_seconds", "Time taken by database queries.")
+
+	def __getattr__(self, name: str) -> Any:
+		attr = getattr(self._db, name)
+		if name not in self.QUERY_METHODS:
+			return attr
+
+		@functools.wraps(attr)
+		async def query(*args, **kwargs):
+			with self._histogram.time(method=name):
+				return await attr(*args, **kwargs)
+		return query